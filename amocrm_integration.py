@@ -2,19 +2,36 @@
 from __future__ import annotations
 
 import base64
+import codecs
+import contextlib
+import contextvars
 import hashlib
 import hmac
 import io
+import itertools
 import json
+import logging
 import os
+import queue
+import random
+import re
+import tempfile
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from email.utils import formatdate
+from datetime import date
+from decimal import Decimal
 from typing import Any, Dict, Optional, Tuple
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 
 import requests
+from requests.adapters import HTTPAdapter
 from flask import (
     Blueprint,
     current_app,
+    g,
+    has_request_context,
     jsonify,
     redirect,
     render_template,
@@ -38,6 +55,7 @@ except Exception:
 # ======== Optional Excel ========
 try:
     from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
     from openpyxl.styles import Font, Alignment, Border, Side, PatternFill
 except Exception:
     Workbook = None  # type: ignore
@@ -52,6 +70,33 @@ AMO_STATE_SECRET = os.getenv("AMO_STATE_SECRET", "change-me")
 WON_STATUS_ID = 142
 LOST_STATUS_ID = 143
 
+AMO_HTTP_POOL = int(os.getenv("AMO_HTTP_POOL", "4"))            # соединений на один аккаунт (base_domain)
+AMO_HTTP_RETRIES = int(os.getenv("AMO_HTTP_RETRIES", "3"))      # повторы идемпотентных GET
+AMO_HTTP_BACKOFF_MAX_SEC = float(os.getenv("AMO_HTTP_BACKOFF_MAX_SEC", "10"))
+
+# лимит amoCRM — ~7 запросов/с на аккаунт; держимся ниже и оставляем резерв под дашборды
+AMO_RATE_RPS = float(os.getenv("AMO_RATE_RPS", "6"))
+AMO_RATE_BURST = float(os.getenv("AMO_RATE_BURST", "6"))
+AMO_RATE_INTERACTIVE_RESERVE = float(os.getenv("AMO_RATE_INTERACTIVE_RESERVE", "2"))
+AMO_RATE_MAX_WAIT_SEC = float(os.getenv("AMO_RATE_MAX_WAIT_SEC", "30"))
+
+# инкрементальная синхронизация в amocrm_metrics_daily
+AMO_SYNC_INTERVAL_MIN = int(os.getenv("AMO_SYNC_INTERVAL_MIN", "10"))
+AMO_SYNC_INITIAL_DAYS = int(os.getenv("AMO_SYNC_INITIAL_DAYS", "90"))
+AMO_SYNC_OVERLAP_SEC = int(os.getenv("AMO_SYNC_OVERLAP_SEC", "300"))
+AMO_SYNC_LOCK_SEC = int(os.getenv("AMO_SYNC_LOCK_SEC", "600"))  # аренда записи агрегатов, продлевается на каждой странице
+
+AMO_FETCH_WORKERS = int(os.getenv("AMO_FETCH_WORKERS", "3"))                 # параллельных срезов на один скан
+AMO_FETCH_SLICE_SEC = int(os.getenv("AMO_FETCH_SLICE_SEC", str(7 * 86400)))  # ширина среза периода
+AMO_FETCH_QUEUE_PAGES = int(os.getenv("AMO_FETCH_QUEUE_PAGES", "4"))         # страниц в очереди среза
+
+AMO_WEBHOOK_FLUSH_SEC = float(os.getenv("AMO_WEBHOOK_FLUSH_SEC", "2"))          # окно склейки вебхуков в пачку
+AMO_WEBHOOK_RECONCILE_SEC = int(os.getenv("AMO_WEBHOOK_RECONCILE_SEC", "300"))  # опрос «сегодня» при живых вебхуках
+
+AMO_USERS_TTL_SEC = int(os.getenv("AMO_USERS_TTL_SEC", str(6 * 3600)))  # справочник пользователей amoCRM
+
+log = logging.getLogger("amocrm")
+
 
 # ======== Blueprints ========
 bp_amocrm_company_api = Blueprint(
@@ -86,7 +131,22 @@ def _session_key(company_id: int) -> str:
 def _save_tokens(company_id: int, data: Dict[str, Any]) -> None:
     expires_at = int(time.time()) + int(data.get("expires_in", 0))
     base_domain = data.get("base_domain") or data.get("domain")
-    if Company and db:
+    if AmoConnection is not None:
+        # токены в БД — нужны фоновой синхронизации, у которой нет Flask-сессии
+        conn = AmoConnection.query.filter_by(company_id=company_id).first()  # type: ignore
+        if conn is None:
+            conn = AmoConnection(company_id=company_id)  # type: ignore
+            db.session.add(conn)
+        if conn.base_domain and base_domain and conn.base_domain.lower() != str(base_domain).lower():
+            _reset_sync_state(company_id)  # другой аккаунт — старые агрегаты не про него
+        conn.access_token = data.get("access_token")
+        conn.refresh_token = data.get("refresh_token")
+        conn.token_type = data.get("token_type")
+        conn.base_domain = base_domain
+        conn.expires_at = expires_at
+        conn.last_sync_at = conn.last_sync_at or int(time.time())
+        db.session.commit()
+    elif Company and db:
         company = _get_company(company_id)
         if company is None:
             return
@@ -110,6 +170,24 @@ def _save_tokens(company_id: int, data: Dict[str, Any]) -> None:
         }
 
 def _read_tokens(company_id: int) -> Optional[Dict[str, Any]]:
+    if AmoConnection is not None:
+        conn = AmoConnection.query.filter_by(company_id=company_id).first()  # type: ignore
+        if conn and conn.access_token:
+            return {
+                "access_token": conn.access_token,
+                "refresh_token": conn.refresh_token,
+                "token_type": conn.token_type,
+                "base_domain": conn.base_domain,
+                "expires_at": conn.expires_at,
+                "last_sync_at": conn.last_sync_at,
+            }
+        # токены, сохранённые раньше только в сессии, переносим в БД при первом обращении
+        legacy = session.get(_session_key(company_id)) if has_request_context() else None
+        if legacy and legacy.get("access_token"):
+            _save_tokens(company_id, {**legacy, "expires_in": int(legacy.get("expires_at") or 0) - int(time.time())})
+            session.pop(_session_key(company_id), None)
+            return _read_tokens(company_id)
+        return None
     if Company and db:
         c = _get_company(company_id)
         if not c:
@@ -125,10 +203,14 @@ def _read_tokens(company_id: int) -> Optional[Dict[str, Any]]:
             "expires_at": getattr(c, "amo_expires_at", None),
             "last_sync_at": getattr(c, "amo_last_sync_at", None) if hasattr(c, "amo_last_sync_at") else None,
         }
-    return session.get(_session_key(company_id))
+    return session.get(_session_key(company_id)) if has_request_context() else None
 
 def _clear_tokens(company_id: int) -> None:
-    if Company and db:
+    if AmoConnection is not None:
+        AmoConnection.query.filter_by(company_id=company_id).delete()  # type: ignore
+        _reset_sync_state(company_id)
+        db.session.commit()
+    elif Company and db:
         c = _get_company(company_id)
         if c:
             for k in ("amo_access_token", "amo_refresh_token", "amo_token_type", "amo_domain", "amo_expires_at", "amo_last_sync_at"):
@@ -136,7 +218,8 @@ def _clear_tokens(company_id: int) -> None:
                     setattr(c, k, None)
             db.session.add(c)
             db.session.commit()
-    session.pop(_session_key(company_id), None)
+    if has_request_context():
+        session.pop(_session_key(company_id), None)
 
 def _callback_url(company_id: int) -> str:
     return f"{AMO_REDIRECT_BASE}/api/partners/company/{company_id}/crm/amocrm/callback"
@@ -166,7 +249,6 @@ def _refresh_if_needed(company_id: int) -> Optional[Dict[str, Any]]:
     if not (refresh and base_domain and AMO_CLIENT_ID and AMO_CLIENT_SECRET):
         return t
     try:
-        token_url = f"https://{base_domain}/oauth2/access_token"
         payload = {
             "client_id": AMO_CLIENT_ID,
             "client_secret": AMO_CLIENT_SECRET,
@@ -174,7 +256,7 @@ def _refresh_if_needed(company_id: int) -> Optional[Dict[str, Any]]:
             "refresh_token": refresh,
             "redirect_uri": _callback_url(company_id),
         }
-        r = requests.post(token_url, json=payload, timeout=15)
+        r = _amo_request("POST", base_domain, "/oauth2/access_token", json_body=payload, timeout=15)
         if r.status_code == 200:
             data = r.json()
             if "base_domain" not in data:
@@ -188,18 +270,247 @@ def _refresh_if_needed(company_id: int) -> Optional[Dict[str, Any]]:
         current_app.logger.exception("AMO refresh exception")
         return t
 
-def _amo_get(base_domain: str, access_token: str, path: str, params: Dict[str, Any]) -> requests.Response:
+# ======== Rate governor (на аккаунт amoCRM) ========
+class AmoRateLimited(requests.RequestException):
+    """Не дождались слота у governor'а за AMO_RATE_MAX_WAIT_SEC."""
+
+class AmoFetchUnavailable(requests.RequestException):
+    """Ждали чужую загрузку того же ключа кэша, а она упала или не уложилась в AMO_CACHE_WAIT_SEC."""
+
+_amo_priority: contextvars.ContextVar[str] = contextvars.ContextVar("amo_priority", default="interactive")
+
+@contextlib.contextmanager
+def amo_priority(priority: str):
+    """with amo_priority("background"): … — запросы фоновой синхронизации уступают дашбордам."""
+    token = _amo_priority.set(priority)
+    try:
+        yield
+    finally:
+        _amo_priority.reset(token)
+
+class _AmoGovernor:
+    """
+    Token bucket на base_domain, общий для всех потоков процесса.
+      - interactive берёт любой доступный токен и имеет приоритет в очереди;
+      - background ждёт, пока в ведре останется больше AMO_RATE_INTERACTIVE_RESERVE токенов,
+        и уступает, если есть ждущие interactive;
+      - 429/Retry-After блокирует аккаунт целиком до указанного момента.
+    """
+
+    def __init__(self, rps: float, burst: float, reserve: float):
+        self._cond = threading.Condition()
+        self._rate = max(0.1, rps)
+        self._burst = max(1.0, burst)
+        self._reserve = max(0.0, min(reserve, self._burst - 1))
+        self._buckets: Dict[str, Dict[str, float]] = {}
+
+    def _bucket(self, domain: str) -> Dict[str, float]:
+        b = self._buckets.get(domain)
+        if b is None:
+            b = self._buckets[domain] = {"tokens": self._burst, "ts": time.monotonic(),
+                                         "blocked_until": 0.0, "interactive_waiting": 0}
+        return b
+
+    def acquire(self, domain: str, priority: str = "interactive", timeout: float = AMO_RATE_MAX_WAIT_SEC) -> bool:
+        interactive = priority != "background"
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            b = self._bucket((domain or "").lower())
+            if interactive:
+                b["interactive_waiting"] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    b["tokens"] = min(self._burst, b["tokens"] + (now - b["ts"]) * self._rate)
+                    b["ts"] = now
+                    need = 1.0 if interactive else 1.0 + self._reserve
+                    if now < b["blocked_until"]:
+                        wait = b["blocked_until"] - now
+                    elif not interactive and b["interactive_waiting"] > 0:
+                        wait = 1.0 / self._rate
+                    elif b["tokens"] >= need:
+                        b["tokens"] -= 1.0
+                        return True
+                    else:
+                        wait = (need - b["tokens"]) / self._rate
+                    left = deadline - now
+                    if left <= 0:
+                        return False
+                    self._cond.wait(min(wait, left))
+            finally:
+                if interactive:
+                    b["interactive_waiting"] -= 1
+
+    def penalize(self, domain: str, seconds: float) -> None:
+        with self._cond:
+            b = self._bucket((domain or "").lower())
+            b["blocked_until"] = max(b["blocked_until"], time.monotonic() + seconds)
+            b["tokens"] = 0.0
+
+_governor = _AmoGovernor(AMO_RATE_RPS, AMO_RATE_BURST, AMO_RATE_INTERACTIVE_RESERVE)
+
+
+# ======== HTTP (пул соединений на аккаунт) ========
+_http_sessions: Dict[str, requests.Session] = {}
+_http_lock = threading.Lock()
+
+def _http_session(base_domain: str) -> requests.Session:
+    """Один keep-alive requests.Session на base_domain: страницы лидов идут по одному соединению."""
+    key = (base_domain or "").lower()
+    with _http_lock:
+        s = _http_sessions.get(key)
+        if s is None:
+            s = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=AMO_HTTP_POOL, max_retries=0)
+            s.mount("https://", adapter)
+            s.mount("http://", adapter)
+            _http_sessions[key] = s
+        return s
+
+def _retry_after_sec(r: requests.Response) -> float:
+    try:
+        return max(0.0, float(r.headers.get("Retry-After") or 0))
+    except ValueError:
+        return 0.0
+
+def _amo_request(method: str, base_domain: str, path: str, *,
+                 headers: Optional[Dict[str, str]] = None, params: Optional[Dict[str, Any]] = None,
+                 json_body: Optional[Dict[str, Any]] = None, timeout: float = 20,
+                 stream: bool = False) -> requests.Response:
+    """
+    Запрос к https://{base_domain}{path} через пуловую сессию аккаунта.
+    Каждая попытка сначала берёт слот у governor'а (приоритет — из amo_priority()).
+    GET повторяется на 429/5xx/сетевых ошибках с экспоненциальной паузой и джиттером;
+    429 блокирует аккаунт на Retry-After. POST (обмен токенов) — без повторов.
+    Каждая попытка логируется с временем. stream=True — тело читается вызывающим (и он закрывает ответ).
+    """
+    method = method.upper()
     url = f"https://{base_domain}{path}"
-    return requests.get(url, headers=_amo_headers(access_token), params=params, timeout=20)
+    attempts = 1 + (AMO_HTTP_RETRIES if method == "GET" else 0)
+    sess = _http_session(base_domain)
+    priority = _amo_priority.get()
+    for attempt in range(1, attempts + 1):
+        if not _governor.acquire(base_domain, priority):
+            log.warning("AMO %s %s%s: no rate slot in %.0fs (%s)", method, base_domain, path,
+                        AMO_RATE_MAX_WAIT_SEC, priority)
+            raise AmoRateLimited(f"amoCRM rate limit: no slot for {base_domain}")
+        t0 = time.perf_counter()
+        try:
+            r = sess.request(method, url, headers=headers, params=params, json=json_body,
+                             timeout=(5, timeout), stream=stream)
+        except requests.RequestException as e:
+            log.warning("AMO %s %s%s failed in %.0fms (attempt %d/%d): %r",
+                        method, base_domain, path, (time.perf_counter() - t0) * 1000, attempt, attempts, e)
+            if attempt >= attempts:
+                raise
+            time.sleep(min(AMO_HTTP_BACKOFF_MAX_SEC, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5))
+            continue
+
+        log.info("AMO %s %s%s -> %s in %.0fms (attempt %d)",
+                 method, base_domain, path, r.status_code, (time.perf_counter() - t0) * 1000, attempt)
+        if r.status_code == 429:
+            # весь аккаунт ждёт Retry-After (или хотя бы секунду) — governor не выдаст слоты раньше
+            _governor.penalize(base_domain, _retry_after_sec(r) or 1.0)
+        if attempt < attempts and (r.status_code == 429 or r.status_code >= 500):
+            r.close()
+            time.sleep(min(AMO_HTTP_BACKOFF_MAX_SEC, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5))
+            continue
+        return r
+    raise requests.RequestException("unreachable")  # pragma: no cover
+
+def _amo_get(base_domain: str, access_token: str, path: str, params: Dict[str, Any],
+             stream: bool = False) -> requests.Response:
+    return _amo_request("GET", base_domain, path, headers=_amo_headers(access_token), params=params, stream=stream)
+
+# ======== Leads (потоковый разбор) ========
+class _Lead:
+    """Проекция лида amoCRM: только поля, нужные агрегатам; кастомные поля и _embedded не храним."""
+    __slots__ = ("id", "status_id", "responsible_user_id", "price", "created_at", "closed_at", "updated_at")
+
+    def __init__(self, d: Dict[str, Any]):
+        self.id = int(d["id"]) if d.get("id") is not None else None
+        self.status_id = int(d.get("status_id") or 0)
+        self.responsible_user_id = int(d.get("responsible_user_id") or 0)
+        self.price = d.get("price") or 0
+        self.created_at = int(d.get("created_at") or 0)
+        self.closed_at = int(d.get("closed_at") or 0)
+        self.updated_at = int(d.get("updated_at") or 0)
+
+_LEADS_ARRAY = re.compile(r'"_embedded"\s*:\s*\{\s*"leads"\s*:\s*\[')
+_json_decoder = json.JSONDecoder()
+
+def _parse_leads(r: requests.Response):
+    """
+    Инкрементальный разбор страницы /api/v4/leads (ответ с stream=True): тело читается кусками,
+    каждый элемент _embedded.leads декодируется raw_decode и сразу сжимается в _Lead —
+    в памяти одновременно только кусок тела и один лид. После «]» хвост тела дочитывается:
+    недочитанный chunked-ответ нельзя вернуть в пул, и close() рвал бы keep-alive на каждой
+    странице. close() — только при ошибке или брошенном генераторе.
+    """
+    chunks = r.iter_content(chunk_size=64 * 1024)
+    dec = codecs.getincrementaldecoder(r.encoding or "utf-8")(errors="replace")
+    buf, pos = "", 0
+    drained = False
+
+    def more() -> bool:
+        nonlocal buf, drained
+        chunk = next(chunks, None)
+        drained = chunk is None
+        text = dec.decode(chunk or b"", final=chunk is None)
+        buf += text
+        return chunk is not None or bool(text)
 
-def _fetch_users_map(base_domain: str, access_token: str) -> Dict[int, Dict[str, Any]]:
+    try:
+        while True:
+            m = _LEADS_ARRAY.search(buf)
+            if m:
+                pos = m.end()
+                break
+            if not more():
+                return
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buf):
+                buf, pos = "", 0
+                if not more():
+                    return
+                continue
+            if buf[pos] == "]":
+                for _ in chunks:
+                    pass
+                drained = True
+                return
+            try:
+                obj, end = _json_decoder.raw_decode(buf, pos)
+            except ValueError:
+                buf, pos = buf[pos:], 0
+                if not more():
+                    raise
+                continue
+            yield _Lead(obj)
+            pos = end
+            if pos > 64 * 1024:
+                buf, pos = buf[pos:], 0
+    finally:
+        if not drained:
+            r.close()
+
+def _fetch_users_map(base_domain: str, access_token: str,
+                     if_modified_since: Optional[int] = None) -> Optional[Dict[int, Dict[str, Any]]]:
     """
-    Возвращает { id: {id, name, email?} }
+    Возвращает { id: {id, name, email?} }.
+    С if_modified_since (epoch) amoCRM может ответить 304 — тогда None: список не менялся.
     """
     out: Dict[int, Dict[str, Any]] = {}
     page, limit = 1, 250
     while True:
-        r = _amo_get(base_domain, access_token, "/api/v4/users", {"page": page, "limit": limit})
+        headers = _amo_headers(access_token)
+        if if_modified_since and page == 1:
+            headers["If-Modified-Since"] = formatdate(if_modified_since, usegmt=True)
+        r = _amo_request("GET", base_domain, "/api/v4/users", headers=headers, params={"page": page, "limit": limit})
+        if r.status_code == 304 and page == 1:
+            return None
         if r.status_code != 200:
             current_app.logger.warning("AMO users fetch %s: %s", r.status_code, r.text)
             break
@@ -218,53 +529,101 @@ def _fetch_users_map(base_domain: str, access_token: str) -> Dict[int, Dict[str,
         page += 1
     return out
 
-def _iter_closed_leads(base_domain: str, access_token: str, ts_from: int, ts_to: int):
+def _fetch_slice(base_domain: str, access_token: str, field: str, ts_from: int, ts_to: int,
+                 out: queue.Queue, stop: threading.Event) -> None:
+    """Постранично тянет лиды одного временного среза в свою ограниченную очередь; в конце — None."""
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
     page, limit = 1, 250
-    while True:
-        params = {
-            "page": page,
-            "limit": limit,
-            "filter[closed_at][from]": ts_from,
-            "filter[closed_at][to]": ts_to,
-            "order[closed_at]": "desc",
-        }
-        r = _amo_get(base_domain, access_token, "/api/v4/leads", params)
-        if r.status_code != 200:
-            current_app.logger.error("AMO leads fetch %s: %s", r.status_code, r.text)
-            break
-        data = r.json() or {}
-        leads = (data.get("_embedded") or {}).get("leads") or []
-        if not leads:
-            break
-        for lead in leads:
-            yield lead
-        if len(leads) < limit:
-            break
-        page += 1
+    try:
+        while not stop.is_set():
+            params = {
+                "page": page,
+                "limit": limit,
+                f"filter[{field}][from]": ts_from,
+                f"filter[{field}][to]": ts_to,
+                f"order[{field}]": "desc",
+            }
+            r = _amo_get(base_domain, access_token, "/api/v4/leads", params, stream=True)
+            if r.status_code == 204:
+                r.close()
+                break
+            if r.status_code != 200:
+                log.error("AMO leads(%s) fetch %s: %s", field, r.status_code, r.text)
+                r.close()
+                break
+            leads = list(_parse_leads(r))
+            if leads and not put(leads):
+                return
+            if len(leads) < limit:
+                break
+            page += 1
+    except Exception as e:
+        put(e)
+        return
+    put(None)
+
+def _iter_leads_sliced(base_domain: str, access_token: str, field: str, ts_from: int, ts_to: int):
+    """
+    Лиды с {field} в [ts_from, ts_to] по убыванию. Период режется на срезы по AMO_FETCH_SLICE_SEC,
+    до AMO_FETCH_WORKERS срезов качаются параллельно (в пределах _governor), а отдаются строго
+    по порядку: у каждого среза своя очередь на AMO_FETCH_QUEUE_PAGES страниц.
+    Потоки получают копию contextvars (приоритет amo_priority).
+    """
+    slices = []
+    hi = ts_to
+    while hi >= ts_from:
+        lo = max(ts_from, hi - AMO_FETCH_SLICE_SEC + 1)
+        slices.append((lo, hi))
+        hi = lo - 1
+
+    stop = threading.Event()
+    running: list = []
+
+    def spawn(lo: int, hi: int) -> None:
+        q: queue.Queue = queue.Queue(maxsize=AMO_FETCH_QUEUE_PAGES)
+        ctx = contextvars.copy_context()
+        threading.Thread(target=ctx.run, args=(_fetch_slice, base_domain, access_token, field, lo, hi, q, stop),
+                         name="amo-fetch", daemon=True).start()
+        running.append(q)
+
+    pending = iter(slices)
+    try:
+        for lo, hi in itertools.islice(pending, max(1, AMO_FETCH_WORKERS)):
+            spawn(lo, hi)
+        while running:
+            q = running.pop(0)
+            while True:
+                item = q.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield from item
+            nxt = next(pending, None)
+            if nxt:
+                spawn(*nxt)
+    finally:
+        stop.set()
+
+def _iter_closed_leads(base_domain: str, access_token: str, ts_from: int, ts_to: int):
+    return _iter_leads_sliced(base_domain, access_token, "closed_at", ts_from, ts_to)
 
 def _iter_created_leads(base_domain: str, access_token: str, ts_from: int, ts_to: int):
-    page, limit = 1, 250
-    while True:
-        params = {
-            "page": page,
-            "limit": limit,
-            "filter[created_at][from]": ts_from,
-            "filter[created_at][to]": ts_to,
-            "order[created_at]": "desc",
-        }
-        r = _amo_get(base_domain, access_token, "/api/v4/leads", params)
-        if r.status_code != 200:
-            current_app.logger.error("AMO leads(created) fetch %s: %s", r.status_code, r.text)
-            break
-        data = r.json() or {}
-        leads = (data.get("_embedded") or {}).get("leads") or []
-        if not leads:
-            break
-        for lead in leads:
-            yield lead
-        if len(leads) < limit:
-            break
-        page += 1
+    return _iter_leads_sliced(base_domain, access_token, "created_at", ts_from, ts_to)
+
+_scan_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="amo-scan")
+
+def _in_background(gen) -> Future:
+    """Выкачивает генератор в список в отдельном потоке (с копией contextvars)."""
+    return _scan_pool.submit(contextvars.copy_context().run, list, gen)
 
 def _period_from_request() -> Tuple[int, int, int, str]:
     now = int(time.time())
@@ -296,14 +655,16 @@ def _period_from_request() -> Tuple[int, int, int, str]:
     label = f"{days}d"
     return ts_from, ts_to, days, label
 
-def _compute_stats(base_domain: str, access_token: str, ts_from: int, ts_to: int) -> Dict[str, Any]:
-    users_map = _fetch_users_map(base_domain, access_token)  # {id:{id,name,email}}
+def _compute_stats(base_domain: str, access_token: str, ts_from: int, ts_to: int,
+                   users_map: Optional[Dict[int, Dict[str, Any]]] = None) -> Dict[str, Any]:
+    if users_map is None:
+        users_map = _fetch_users_map(base_domain, access_token) or {}  # {id:{id,name,email}}
     by_user = defaultdict(lambda: {"won": 0, "lost": 0})
     total_won = total_lost = 0
 
     for lead in _iter_closed_leads(base_domain, access_token, ts_from, ts_to):
-        status_id = int(lead.get("status_id") or 0)
-        resp_id = lead.get("responsible_user_id") or 0
+        status_id = lead.status_id
+        resp_id = lead.responsible_user_id
         if status_id == WON_STATUS_ID:
             by_user[resp_id]["won"] += 1
             total_won += 1
@@ -360,6 +721,69 @@ if db:
     except Exception:
         AmoUserLink = None  # type: ignore
 
+# ======== Sync storage (токены, курсор, дневные агрегаты) ========
+
+AmoConnection = AmoSyncCursor = AmoMetricsDaily = AmoLeadState = AmoUserDirectory = None
+if db:
+    try:
+        from sqlalchemy import UniqueConstraint, Index
+
+        class AmoConnection(db.Model):  # type: ignore
+            __tablename__ = "amocrm_connections"
+            id = db.Column(db.Integer, primary_key=True)
+            company_id = db.Column(db.Integer, nullable=False, unique=True, index=True)
+            base_domain = db.Column(db.String(255), nullable=True)
+            access_token = db.Column(db.Text, nullable=True)
+            refresh_token = db.Column(db.Text, nullable=True)
+            token_type = db.Column(db.String(32), nullable=True)
+            expires_at = db.Column(db.Integer, nullable=True)      # epoch, как и в прежнем session-хранилище
+            last_sync_at = db.Column(db.Integer, nullable=True)
+
+        class AmoSyncCursor(db.Model):  # type: ignore
+            __tablename__ = "amocrm_sync_cursor"
+            id = db.Column(db.Integer, primary_key=True)
+            company_id = db.Column(db.Integer, nullable=False, unique=True, index=True)
+            updated_since = db.Column(db.Integer, nullable=True)   # epoch: лиды с updated_at >= — уже учтены
+            backfill_from = db.Column(db.Integer, nullable=True)   # epoch: с какой даты агрегаты полные
+            last_run_at = db.Column(db.Integer, nullable=True)
+            last_error = db.Column(db.String(255), nullable=True)
+            lock_until = db.Column(db.Integer, nullable=True)      # epoch: до какого момента агрегаты пишет один владелец
+
+        class AmoMetricsDaily(db.Model):  # type: ignore
+            __tablename__ = "amocrm_metrics_daily"
+            id = db.Column(db.Integer, primary_key=True)
+            company_id = db.Column(db.Integer, index=True, nullable=False)
+            amocrm_user_id = db.Column(db.Integer, index=True, nullable=False)
+            date = db.Column(db.Date, index=True, nullable=False)
+            won_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+            won_sum = db.Column(db.Numeric(14, 2), nullable=False, default=0, server_default="0")
+            lost_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+            lost_sum = db.Column(db.Numeric(14, 2), nullable=False, default=0, server_default="0")
+            __table_args__ = (
+                UniqueConstraint("company_id", "amocrm_user_id", "date", name="uq_metrics_scope"),
+                Index("ix_amo_metrics_company_date", "company_id", "date"),
+            )
+
+        class AmoLeadState(db.Model):  # type: ignore
+            """Последний учтённый вклад лида в агрегаты — чтобы при смене статуса/дня/ответственного откатить его."""
+            __tablename__ = "amocrm_lead_state"
+            company_id = db.Column(db.Integer, primary_key=True)
+            lead_id = db.Column(db.BigInteger, primary_key=True)
+            amocrm_user_id = db.Column(db.Integer, nullable=False, default=0)
+            outcome = db.Column(db.String(8), nullable=True)       # won|lost|None (открыт)
+            closed_date = db.Column(db.Date, nullable=True)
+            price = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+            updated_at = db.Column(db.Integer, nullable=True)
+
+        class AmoUserDirectory(db.Model):  # type: ignore
+            """Кэш справочника пользователей amoCRM: один JSON на компанию + время загрузки."""
+            __tablename__ = "amocrm_user_directory"
+            company_id = db.Column(db.Integer, primary_key=True)
+            users_json = db.Column(db.Text, nullable=False, default="{}")
+            fetched_at = db.Column(db.Integer, nullable=False, default=0)
+    except Exception:
+        AmoConnection = AmoSyncCursor = AmoMetricsDaily = AmoLeadState = AmoUserDirectory = None  # type: ignore
+
 def _ensure_link_table():
     if not (db and AmoUserLink):
         return False
@@ -419,19 +843,805 @@ def _set_mapping(company_id: int, platform_user_id: int, amocrm_user_id: int) ->
     session[key] = m
 
 
+# ======== Users directory (кэш /api/v4/users) ========
+_users_refresh_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="amo-users")
+_users_refreshing: set = set()
+_users_refresh_lock = threading.Lock()
+
+def _load_directory(company_id: int) -> Tuple[Optional[Dict[int, Dict[str, Any]]], int]:
+    row = db.session.get(AmoUserDirectory, company_id)  # type: ignore
+    if not row:
+        return None, 0
+    try:
+        users = {int(k): v for k, v in json.loads(row.users_json or "{}").items()}
+    except Exception:
+        return None, 0
+    return users, int(row.fetched_at or 0)
+
+def _refresh_directory(company_id: int, tok: Dict[str, Any], fetched_at: int = 0) -> Dict[int, Dict[str, Any]]:
+    """Перечитывает справочник (условно, If-Modified-Since) и сохраняет его с новым fetched_at."""
+    with amo_priority("background" if fetched_at else "interactive"):
+        fresh = _fetch_users_map(tok["base_domain"], tok["access_token"], if_modified_since=fetched_at or None)
+    row = db.session.get(AmoUserDirectory, company_id)  # type: ignore
+    if row is None:
+        row = AmoUserDirectory(company_id=company_id)  # type: ignore
+        db.session.add(row)
+    if fresh:
+        row.users_json = json.dumps({str(k): v for k, v in fresh.items()}, ensure_ascii=False)
+        row.fetched_at = int(time.time())
+    elif fresh is None:
+        row.fetched_at = int(time.time())  # 304: список тот же, продлеваем TTL
+    # пустой ответ (ошибка API) прежний справочник не затирает и TTL не продлевает
+    db.session.commit()
+    if not fresh:
+        fresh, _ = _load_directory(company_id)
+    return fresh or {}
+
+def _refresh_directory_async(app, company_id: int, tok: Dict[str, Any], fetched_at: int) -> None:
+    with _users_refresh_lock:
+        if company_id in _users_refreshing:
+            return
+        _users_refreshing.add(company_id)
+
+    def job():
+        try:
+            with app.app_context():
+                _refresh_directory(company_id, tok, fetched_at)
+        except Exception:
+            log.warning("AMO users directory refresh company=%s failed", company_id, exc_info=True)
+        finally:
+            with _users_refresh_lock:
+                _users_refreshing.discard(company_id)
+
+    _users_refresh_pool.submit(job)
+
+def _users_directory(company_id: int, tok: Dict[str, Any], force: bool = False) -> Dict[int, Dict[str, Any]]:
+    """
+    Справочник пользователей amoCRM компании из БД. Пока свеж (AMO_USERS_TTL_SEC) — без API;
+    устарел — отдаём как есть и обновляем в фоне; нет вовсе (или force) — грузим синхронно.
+    """
+    if AmoUserDirectory is None:
+        return _fetch_users_map(tok["base_domain"], tok["access_token"]) or {}
+    users, fetched_at = _load_directory(company_id)
+    if users is None or force:
+        return _refresh_directory(company_id, tok, 0 if users is None else fetched_at)
+    if time.time() - fetched_at > AMO_USERS_TTL_SEC:
+        _refresh_directory_async(current_app._get_current_object(), company_id, tok, fetched_at)
+    return users
+
+
+# ======== Sync engine ========
+
+def _iter_updated_leads(base_domain: str, access_token: str, ts_from: int, ts_to: int):
+    """
+    Лиды, изменённые в [ts_from, ts_to], по возрастанию updated_at — постранично, keyset по
+    (updated_at, id): каждая следующая страница запрашивается с filter[updated_at][from] = updated_at
+    последнего лида, а уже виденные на этой секунде id отбрасываются. page=N по живой выборке
+    терял лиды: изменённый посреди прохода лид уезжал в конец и сдвигал ещё не прочитанные
+    на уже прочитанную страницу. page>1 остаётся только для пачек больше страницы в одну секунду.
+    """
+    limit = 250
+    since, page = ts_from, 1
+    seen: set = set()  # id лидов с updated_at == since, уже отданные
+    while True:
+        params = {
+            "page": page,
+            "limit": limit,
+            "filter[updated_at][from]": since,
+            "filter[updated_at][to]": ts_to,
+            "order[updated_at]": "asc",
+        }
+        r = _amo_get(base_domain, access_token, "/api/v4/leads", params, stream=True)
+        if r.status_code == 204:
+            r.close()
+            break
+        if r.status_code != 200:
+            r.close()
+            raise requests.RequestException(f"AMO leads(updated) fetch {r.status_code}: {r.text[:200]}")
+        leads = list(_parse_leads(r))
+        if not leads:
+            break
+        fresh = [l for l in leads if not (l.updated_at <= since and l.id in seen)]
+        if fresh:
+            yield fresh
+        if len(leads) < limit:
+            break
+        last = leads[-1].updated_at
+        if last > since:
+            since, page = last, 1
+            seen = {l.id for l in leads if l.updated_at == last}
+        else:
+            seen.update(l.id for l in leads)
+            page += 1
+
+def _lead_outcome(lead: _Lead, known_closed: Optional[date] = None) -> Tuple[Optional[str], Optional[date], int, Decimal]:
+    """known_closed — уже учтённый день закрытия: вебхук правки закрытого лида приходит без closed_at."""
+    status_id = lead.status_id
+    outcome = "won" if status_id == WON_STATUS_ID else "lost" if status_id == LOST_STATUS_ID else None
+    closed_at = lead.closed_at
+    closed_date = date.fromtimestamp(closed_at) if outcome and closed_at else known_closed if outcome else None
+    if outcome and closed_date is None:
+        outcome = None  # закрытый без closed_at в дневные агрегаты не положить
+    uid = lead.responsible_user_id
+    price = Decimal(str(lead.price))
+    return outcome, closed_date, uid, price
+
+def _apply_leads_page(company_id: int, leads: list) -> int:
+    """
+    Применяет страницу изменённых лидов: откатывает прежний вклад лида (amocrm_lead_state)
+    и добавляет новый. Дельты копятся по (user, day) и пишутся одним проходом. Возвращает число изменений.
+    """
+    ids = [l.id for l in leads if l.id is not None]
+    states = {st.lead_id: st for st in AmoLeadState.query.filter(  # type: ignore
+        AmoLeadState.company_id == company_id, AmoLeadState.lead_id.in_(ids)).all()}  # type: ignore
+
+    deltas: Dict[Tuple[int, date], Dict[str, Any]] = defaultdict(
+        lambda: {"won_count": 0, "won_sum": Decimal(0), "lost_count": 0, "lost_sum": Decimal(0)})
+    changed = 0
+    for lead in leads:
+        if lead.id is None:
+            continue
+        lid = lead.id
+        st = states.get(lid)
+        outcome, closed_date, uid, price = _lead_outcome(lead, st.closed_date if st else None)
+        if st and lead.updated_at and st.updated_at and lead.updated_at < st.updated_at:
+            continue  # опоздавший вебхук со старой версией лида
+        if st and (st.outcome, st.closed_date, st.amocrm_user_id, Decimal(st.price or 0)) == (outcome, closed_date, uid, price):
+            continue
+        if st and st.outcome:
+            d = deltas[(st.amocrm_user_id, st.closed_date)]
+            d[f"{st.outcome}_count"] -= 1
+            d[f"{st.outcome}_sum"] -= Decimal(st.price or 0)
+        if outcome:
+            d = deltas[(uid, closed_date)]
+            d[f"{outcome}_count"] += 1
+            d[f"{outcome}_sum"] += price
+        if st is None:
+            st = AmoLeadState(company_id=company_id, lead_id=lid)  # type: ignore
+            db.session.add(st)
+            states[lid] = st
+        st.amocrm_user_id, st.outcome, st.closed_date, st.price = uid, outcome, closed_date, price
+        st.updated_at = lead.updated_at
+        changed += 1
+
+    deltas = {k: v for k, v in deltas.items() if any(v.values())}
+    if deltas:
+        existing = {(m.amocrm_user_id, m.date): m for m in AmoMetricsDaily.query.filter(  # type: ignore
+            AmoMetricsDaily.company_id == company_id,  # type: ignore
+            AmoMetricsDaily.date.in_({k[1] for k in deltas}),  # type: ignore
+            AmoMetricsDaily.amocrm_user_id.in_({k[0] for k in deltas}),  # type: ignore
+        ).all()}
+        for (uid, day), d in deltas.items():
+            m = existing.get((uid, day))
+            if m is None:
+                m = AmoMetricsDaily(company_id=company_id, amocrm_user_id=uid, date=day,  # type: ignore
+                                    won_count=0, won_sum=0, lost_count=0, lost_sum=0)
+                db.session.add(m)
+            m.won_count = (m.won_count or 0) + d["won_count"]
+            m.won_sum = Decimal(m.won_sum or 0) + d["won_sum"]
+            m.lost_count = (m.lost_count or 0) + d["lost_count"]
+            m.lost_sum = Decimal(m.lost_sum or 0) + d["lost_sum"]
+    return changed
+
+def _reset_sync_state(company_id: int) -> None:
+    _reset_today(company_id)
+    if not (AmoSyncCursor and AmoMetricsDaily and AmoLeadState and AmoUserDirectory):
+        return
+    for model in (AmoSyncCursor, AmoMetricsDaily, AmoLeadState, AmoUserDirectory):
+        model.query.filter_by(company_id=company_id).delete()  # type: ignore
+
+_company_locks: Dict[int, threading.Lock] = {}
+_company_locks_guard = threading.Lock()
+
+class _SyncLease:
+    """
+    Один писатель amocrm_lead_state/amocrm_metrics_daily на компанию: _apply_leads_page читает и
+    правит строки в Python, и параллельные синк/ручной синк/вебхуки теряли бы дельты друг друга.
+    В процессе — threading.Lock, между процессами — аренда amocrm_sync_cursor.lock_until
+    (условный UPDATE); истёкшая аренда упавшего воркера забирается следующим.
+    """
+
+    def __init__(self, company_id: int):
+        self.company_id = company_id
+        self.until = 0
+        with _company_locks_guard:
+            self._lock = _company_locks.setdefault(company_id, threading.Lock())
+
+    def _claim(self) -> bool:
+        from sqlalchemy import update, or_
+        if not AmoSyncCursor.query.filter_by(company_id=self.company_id).first():  # type: ignore
+            try:
+                db.session.add(AmoSyncCursor(company_id=self.company_id))  # type: ignore
+                db.session.commit()
+            except Exception:
+                db.session.rollback()  # курсор создал соседний процесс
+        now = int(time.time())
+        self.until = now + AMO_SYNC_LOCK_SEC
+        res = db.session.execute(
+            update(AmoSyncCursor)  # type: ignore
+            .where(AmoSyncCursor.company_id == self.company_id,  # type: ignore
+                   or_(AmoSyncCursor.lock_until.is_(None), AmoSyncCursor.lock_until < now))  # type: ignore
+            .values(lock_until=self.until)
+            .execution_options(synchronize_session=False))
+        db.session.commit()
+        return res.rowcount == 1
+
+    def _set(self, value: Optional[int]) -> None:
+        from sqlalchemy import update
+        db.session.execute(
+            update(AmoSyncCursor)  # type: ignore
+            .where(AmoSyncCursor.company_id == self.company_id, AmoSyncCursor.lock_until == self.until)  # type: ignore
+            .values(lock_until=value)
+            .execution_options(synchronize_session=False))
+
+    def acquire(self) -> bool:
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            if self._claim():
+                return True
+        except Exception:
+            db.session.rollback()
+            log.exception("AMO sync lock company=%s: claim failed", self.company_id)
+        self._lock.release()
+        return False
+
+    def renew(self) -> None:
+        """Продлевает аренду в текущей транзакции — уходит тем же commit, что и страница."""
+        until = int(time.time()) + AMO_SYNC_LOCK_SEC
+        self._set(until)
+        self.until = until
+
+    def release(self) -> None:
+        try:
+            self._set(None)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            log.exception("AMO sync lock company=%s: release failed, lease expires in %ss",
+                          self.company_id, AMO_SYNC_LOCK_SEC)
+        finally:
+            self._lock.release()
+
+def sync_company(company_id: int) -> Dict[str, Any]:
+    """
+    Инкрементальная синхронизация: тянем только лиды с updated_at >= cursor.updated_since
+    (с небольшим перекрытием), первый запуск — за AMO_SYNC_INITIAL_DAYS. Каждая страница —
+    своя транзакция; курсор сдвигается только после успешного прохода. Если компанию уже
+    синхронизирует другой поток/процесс — выходим с busy, следующий запуск догонит.
+    """
+    if not (AmoSyncCursor and AmoMetricsDaily and AmoLeadState):
+        return {"ok": False, "error": "sync storage unavailable"}
+    tok = _refresh_if_needed(company_id)
+    if not tok or not tok.get("base_domain") or not tok.get("access_token"):
+        return {"ok": False, "error": "not connected"}
+
+    lease = _SyncLease(company_id)
+    if not lease.acquire():
+        log.info("AMO sync company=%s skipped: already running", company_id)
+        return {"ok": False, "error": "busy"}
+    try:
+        return _sync_company_locked(company_id, tok, lease)
+    finally:
+        lease.release()
+
+def _sync_company_locked(company_id: int, tok: Dict[str, Any], lease: _SyncLease) -> Dict[str, Any]:
+    cur = AmoSyncCursor.query.filter_by(company_id=company_id).first()  # type: ignore
+    run_started = int(time.time())
+    if cur.updated_since:
+        since = int(cur.updated_since) - AMO_SYNC_OVERLAP_SEC
+    else:
+        since = run_started - AMO_SYNC_INITIAL_DAYS * 86400
+
+    pages = changed = 0
+    t0 = time.perf_counter()
+    try:
+        with amo_priority("background"):
+            for leads in _iter_updated_leads(tok["base_domain"], tok["access_token"], since, run_started):
+                changed += _apply_leads_page(company_id, leads)
+                pages += 1
+                lease.renew()
+                db.session.commit()
+    except requests.RequestException as e:
+        db.session.rollback()
+        cur.last_error = str(e)[:255]
+        cur.last_run_at = run_started
+        db.session.commit()
+        log.warning("AMO sync company=%s failed after %d pages: %r", company_id, pages, e)
+        return {"ok": False, "error": "amoCRM request failed", "pages": pages, "changed": changed}
+
+    if not cur.updated_since:
+        cur.backfill_from = since
+    cur.updated_since = run_started
+    cur.last_run_at = run_started
+    cur.last_error = None
+    conn = AmoConnection.query.filter_by(company_id=company_id).first() if AmoConnection else None  # type: ignore
+    if conn:
+        conn.last_sync_at = run_started
+    db.session.commit()
+    log.info("AMO sync company=%s: %d pages, %d leads changed in %.1fs",
+             company_id, pages, changed, time.perf_counter() - t0)
+    return {"ok": True, "pages": pages, "changed": changed, "updated_since": run_started}
+
+def _daily_ready(company_id: int, ts_from: int) -> bool:
+    """Агрегаты покрывают период, если синк уже был и бэкфилл начинается не позже ts_from."""
+    if not AmoSyncCursor:
+        return False
+    cur = AmoSyncCursor.query.filter_by(company_id=company_id).first()  # type: ignore
+    return bool(cur and cur.updated_since and cur.backfill_from is not None and cur.backfill_from <= ts_from)
+
+def _stats_from_daily(company_id: int, users_map: Dict[int, Dict[str, Any]], ts_from: int, ts_to: int) -> Dict[str, Any]:
+    """Та же форма, что у _compute_stats, но из amocrm_metrics_daily (гранулярность — день)."""
+    from sqlalchemy import func
+    q = (db.session.query(
+            AmoMetricsDaily.amocrm_user_id,  # type: ignore
+            func.sum(AmoMetricsDaily.won_count), func.sum(AmoMetricsDaily.lost_count),  # type: ignore
+            func.sum(AmoMetricsDaily.won_sum), func.sum(AmoMetricsDaily.lost_sum))  # type: ignore
+         .filter(AmoMetricsDaily.company_id == company_id,  # type: ignore
+                 AmoMetricsDaily.date >= date.fromtimestamp(ts_from),  # type: ignore
+                 AmoMetricsDaily.date <= date.fromtimestamp(ts_to))  # type: ignore
+         .group_by(AmoMetricsDaily.amocrm_user_id))  # type: ignore
+    rows = []
+    total_won = total_lost = 0
+    for uid, won, lost, won_sum, lost_sum in q.all():
+        won, lost = int(won or 0), int(lost or 0)
+        if not (won or lost):
+            continue
+        total_won += won
+        total_lost += lost
+        total = won + lost
+        name = (users_map.get(uid) or {}).get("name") if uid else "Без владельца"
+        rows.append({"user_id": uid, "display_name": name, "won": won, "lost": lost,
+                     "conv": round(100 * won / total) if total else 0,
+                     "won_sum": float(won_sum or 0), "lost_sum": float(lost_sum or 0)})
+    return {"won_count": total_won, "lost_count": total_lost, "rows": rows}
+
+def _stats_for_period(company_id: int, tok: Dict[str, Any], ts_from: int, ts_to: int) -> Dict[str, Any]:
+    """Статистика периода: из локальных агрегатов, если они покрывают период, иначе — живым запросом."""
+    users_map = _users_directory(company_id, tok)
+    if _daily_ready(company_id, ts_from):
+        return _stats_from_daily(company_id, users_map, ts_from, ts_to)
+    return _compute_stats(tok["base_domain"], tok["access_token"], ts_from, ts_to, users_map)
+
+def sync_all_companies(app) -> None:
+    """Джоб планировщика: синк всех подключённых аккаунтов (по очереди, фоновый приоритет)."""
+    if AmoConnection is None:
+        return
+    with app.app_context():
+        ids = [cid for (cid,) in db.session.query(AmoConnection.company_id).all()]  # type: ignore
+        for cid in ids:
+            try:
+                sync_company(cid)
+            except Exception:
+                db.session.rollback()
+                log.exception("AMO sync company=%s crashed", cid)
+
+def _sync_company_job(app, company_id: int) -> None:
+    with app.app_context():
+        try:
+            sync_company(company_id)
+        except Exception:
+            db.session.rollback()
+            log.exception("AMO sync company=%s crashed", company_id)
+
+_sync_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="amo-sync")
+
+def queue_sync(app, company_id: int) -> None:
+    """Ручной синк — в фоне: первый бэкфилл за AMO_SYNC_INITIAL_DAYS в HTTP-запрос не укладывается."""
+    from extensions import scheduler
+    if scheduler.running:
+        scheduler.add_job(_sync_company_job, args=[app, company_id], id=f"amocrm_sync_{company_id}",
+                          replace_existing=True, misfire_grace_time=None)
+    else:
+        _sync_pool.submit(_sync_company_job, app, company_id)
+
+def start_sync_jobs(app) -> None:
+    from extensions import scheduler
+    if AMO_SYNC_INTERVAL_MIN <= 0 or AmoConnection is None:
+        return
+    scheduler.add_job(sync_all_companies, "interval", minutes=AMO_SYNC_INTERVAL_MIN, args=[app],
+                      id="amocrm_sync", replace_existing=True, coalesce=True, max_instances=1)
+
+
+# ======== Today accumulator (реалтайм без полного пересканирования) ========
+class _TodayState:
+    """Вклад лидов компании в сегодняшние счётчики: lead_id -> (uid, outcome|None, created_today)."""
+
+    def __init__(self, midnight: int):
+        self.midnight = midnight
+        self.cursor = 0
+        self.pushed_at = 0
+        self.leads: Dict[int, Tuple[int, Optional[str], bool]] = {}
+        self.won: Dict[int, int] = defaultdict(int)
+        self.lost: Dict[int, int] = defaultdict(int)
+        self.created: Dict[int, int] = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def _contribution(self, lead: _Lead) -> Optional[Tuple[int, Optional[str], bool]]:
+        uid = lead.responsible_user_id
+        sid = lead.status_id
+        outcome = "won" if sid == WON_STATUS_ID else "lost" if sid == LOST_STATUS_ID else None
+        if outcome and lead.closed_at < self.midnight:
+            outcome = None
+        created = lead.created_at >= self.midnight
+        if not outcome and not created:
+            return None
+        return uid, outcome, created
+
+    def _add(self, c: Tuple[int, Optional[str], bool], sign: int) -> None:
+        uid, outcome, created = c
+        if outcome == "won":
+            self.won[uid] += sign
+        elif outcome == "lost":
+            self.lost[uid] += sign
+        if created:
+            self.created[uid] += sign
+
+    def apply(self, lead: _Lead) -> None:
+        """Заменяет прежний вклад лида новым (won→lost, смена ответственного, закрытие вчерашнего и т.п.)."""
+        if lead.id is None:
+            return
+        lid = lead.id
+        new = self._contribution(lead)
+        old = self.leads.get(lid)
+        sid = lead.status_id
+        status_outcome = "won" if sid == WON_STATUS_ID else "lost" if sid == LOST_STATUS_ID else None
+        if not lead.closed_at and old and old[1] and old[1] == status_outcome:
+            # правка закрытого сегодня лида без closed_at в вебхуке — закрытие остаётся сегодняшним
+            new = (lead.responsible_user_id or old[0], old[1], new[2] if new else False)
+        if not lead.created_at and old and old[2]:
+            # в вебхуке смены статуса created_at может не прийти — «создан сегодня» сохраняем
+            new = (lead.responsible_user_id or old[0], new[1] if new else None, True)
+        if old == new:
+            return
+        if old:
+            self._add(old, -1)
+        if new:
+            self._add(new, +1)
+            self.leads[lid] = new
+        else:
+            self.leads.pop(lid, None)
+
+_today: Dict[int, _TodayState] = {}
+_today_lock = threading.Lock()
+
+def _local_midnight(now: int) -> int:
+    lt = time.localtime(now)
+    return int(time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday, 0, 0, 0, lt.tm_wday, lt.tm_yday, lt.tm_isdst)))
+
+def _today_counters(company_id: int, tok: Dict[str, Any], now: int) -> _TodayState:
+    """
+    Сегодняшние счётчики компании. Первый запрос дня засевает их полным сканом
+    закрытых/созданных с полуночи, дальше — только лиды с updated_at >= cursor (с перекрытием
+    AMO_SYNC_OVERLAP_SEC): обычно одна небольшая страница. Пока приходят вебхуки, счётчики
+    обновляются ими, а опрос идёт не чаще AMO_WEBHOOK_RECONCILE_SEC — как сверка.
+    """
+    base_domain, access_token = tok["base_domain"], tok["access_token"]
+    midnight = _local_midnight(now)
+    with _today_lock:
+        st = _today.get(company_id)
+        if st is None or st.midnight != midnight:
+            st = _today[company_id] = _TodayState(midnight)
+
+    with st.lock:
+        if st.cursor and st.pushed_at and now - st.cursor < AMO_WEBHOOK_RECONCILE_SEC:
+            return st
+        if not st.cursor:
+            created = _in_background(_iter_created_leads(base_domain, access_token, midnight, now))
+            for lead in _iter_closed_leads(base_domain, access_token, midnight, now):
+                st.apply(lead)
+            for lead in created.result():
+                st.apply(lead)
+        else:
+            for leads in _iter_updated_leads(base_domain, access_token, max(midnight, st.cursor - AMO_SYNC_OVERLAP_SEC), now):
+                for lead in leads:
+                    st.apply(lead)
+        st.cursor = now
+    return st
+
+def _reset_today(company_id: int) -> None:
+    with _today_lock:
+        _today.pop(company_id, None)
+
+
+# ======== Result cache (single-flight + stale-while-revalidate) ========
+AMO_RT_CACHE_TTL_SEC = float(os.getenv("AMO_RT_CACHE_TTL_SEC", "15"))
+AMO_STATS_CACHE_TTL_SEC = float(os.getenv("AMO_STATS_CACHE_TTL_SEC", "60"))
+AMO_CACHE_STALE_SEC = float(os.getenv("AMO_CACHE_STALE_SEC", "600"))
+AMO_CACHE_WAIT_SEC = float(os.getenv("AMO_CACHE_WAIT_SEC", "60"))
+
+_revalidate_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="amo-revalidate")
+
+class _SingleFlightCache:
+    """
+    Кэш результатов по ключу (company, endpoint, period):
+      - свежее значение (< ttl) отдаётся сразу;
+      - устаревшее (< AMO_CACHE_STALE_SEC) отдаётся сразу, а одна фоновая загрузка его обновляет;
+      - при отсутствии значения грузит ровно один вызывающий, остальные ждут его результата.
+    Если загрузка упала, а есть устаревшее значение — оно и остаётся в ответе.
+    Записи старше AMO_CACHE_STALE_SEC выметаются при вставке новых; при переполнении
+    вытесняются самые старые, но не вставляемый ключ и не загружаемые сейчас.
+    """
+
+    def __init__(self, max_entries: int = 2000):
+        self._lock = threading.Lock()
+        self._entries: Dict[tuple, Dict[str, Any]] = {}
+        self._max = max_entries
+
+    def get(self, key: tuple, loader, *, ttl: float) -> Tuple[Any, str]:
+        now = time.time()
+        with self._lock:
+            e = self._entries.get(key)
+            if e is None:
+                e = self._entries[key] = {"value": None, "at": 0.0, "inflight": None}
+                self._prune(now, keep=key)
+            age = now - e["at"]
+            if e["value"] is not None and age < ttl:
+                return e["value"], "hit"
+            stale = e["value"] if e["value"] is not None and age < AMO_CACHE_STALE_SEC else None
+            leader = e["inflight"] is None
+            if leader:
+                e["inflight"] = threading.Event()
+            ev = e["inflight"]
+
+        if stale is not None:
+            if leader:
+                app = current_app._get_current_object()
+                _revalidate_pool.submit(self._load_in_app, app, key, e, loader)
+            return stale, "stale"
+        if leader:
+            return self._load(key, e, loader), "miss"
+
+        ev.wait(AMO_CACHE_WAIT_SEC)
+        with self._lock:
+            if e["value"] is not None:
+                return e["value"], "shared"
+        raise AmoFetchUnavailable(f"amoCRM fetch for {key[1]} failed")
+
+    def _load(self, key: tuple, e: Dict[str, Any], loader):
+        try:
+            value = loader()
+            with self._lock:
+                e["value"], e["at"] = value, time.time()
+            return value
+        finally:
+            with self._lock:
+                ev, e["inflight"] = e["inflight"], None
+            if ev:
+                ev.set()
+
+    def _load_in_app(self, app, key: tuple, e: Dict[str, Any], loader) -> None:
+        try:
+            with app.app_context():
+                self._load(key, e, loader)
+        except Exception:
+            log.warning("AMO revalidate %s failed, serving stale", key, exc_info=True)
+
+    def invalidate(self, company_id: int) -> None:
+        """Сбрасывает закэшированные ответы компании (кроме загружаемых прямо сейчас)."""
+        with self._lock:
+            for k in [k for k, v in self._entries.items() if k[0] == company_id and v["inflight"] is None]:
+                del self._entries[k]
+
+    def _prune(self, now: float, keep: tuple) -> None:
+        idle = [k for k, v in self._entries.items() if v["inflight"] is None and k != keep]
+        for k in idle:
+            e = self._entries[k]
+            if e["value"] is None or now - e["at"] >= AMO_CACHE_STALE_SEC:  # протухшие и неудачные загрузки
+                del self._entries[k]
+        over = len(self._entries) - self._max
+        if over <= 0:
+            return
+        idle = sorted((k for k in idle if k in self._entries), key=lambda k: self._entries[k]["at"])
+        for k in idle[:over]:
+            del self._entries[k]
+
+_result_cache = _SingleFlightCache()
+
+def _resolve_period(label: str, days: int, ts_from: int, ts_to: int) -> Tuple[int, int]:
+    """Относительный период («today», «Nd») пересчитывается на момент загрузки, ручной — как есть."""
+    now = int(time.time())
+    if label == "today":
+        return _local_midnight(now), now
+    if label == "custom":
+        return ts_from, ts_to
+    return now - days * 86400, now
+
+def _stats_payload(company_id: int, tok: Dict[str, Any], ts_from: int, ts_to: int, days: int, label: str) -> Dict[str, Any]:
+    data = _stats_for_period(company_id, tok, ts_from, ts_to)
+    total_all = data["won_count"] + data["lost_count"]
+    conversion = round(100 * data["won_count"] / total_all) if total_all else 0
+    return {
+        "range": label,
+        "from": ts_from,
+        "to": ts_to,
+        "days": days,
+        "won_count": data["won_count"],
+        "lost_count": data["lost_count"],
+        "conversion": conversion,
+        "by_user": data["rows"],
+    }
+
+def _cached_stats(company_id: int, tok: Dict[str, Any], ts_from: int, ts_to: int, days: int, label: str):
+    period = f"{ts_from}-{ts_to}" if label == "custom" else label
+
+    def load():
+        f, t = _resolve_period(label, days, ts_from, ts_to)
+        return _stats_payload(company_id, _refresh_if_needed(company_id) or tok, f, t, days, label)
+
+    return _result_cache.get((company_id, "stats", period), load, ttl=AMO_STATS_CACHE_TTL_SEC)
+
+
+# ======== Webhooks (push изменений лидов от amoCRM) ========
+_WEBHOOK_FIELD = re.compile(r"^leads\[(add|update|status|responsible|restore|delete)\]\[(\d+)\]\[(\w+)\]$")
+_WEBHOOK_SEEN_MAX = 50_000
+
+_webhook_lock = threading.Lock()
+_webhook_buf: Dict[int, Dict[int, _Lead]] = defaultdict(dict)   # company -> lead_id -> последняя версия
+_webhook_seen: OrderedDict[Tuple[int, int], Tuple[int, int, int, int]] = OrderedDict()  # ключи доставок для дедупликации
+_webhook_flush_pending = False
+_webhook_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="amo-webhook")
+
+def _webhook_token(company_id: int) -> str:
+    sig = hmac.new(AMO_STATE_SECRET.encode(), f"webhook:{company_id}".encode(), hashlib.sha256).digest()
+    return _b64url(sig)[:32]
+
+def _webhook_url(company_id: int) -> str:
+    return f"{AMO_REDIRECT_BASE}/api/partners/company/{company_id}/crm/amocrm/webhook/{_webhook_token(company_id)}"
+
+def _leads_from_webhook(form) -> list:
+    """
+    Разбирает x-www-form-urlencoded вебхук amoCRM (leads[status][0][id]=…) в _Lead.
+    В вебхуке нет closed_at: время изменения считаем закрытием только для смены статуса в
+    успех/отказ; правка уже закрытого лида идёт с closed_at=0, и день закрытия берётся из
+    amocrm_lead_state/«сегодня». События без updated_at пропускаем — иначе повтор доставки
+    получил бы новое время и не отсёкся бы дедупликацией. Удаление — как «без исхода».
+    """
+    events: Dict[Tuple[str, int], Dict[str, Any]] = defaultdict(dict)
+    for key, value in form.items():
+        m = _WEBHOOK_FIELD.match(key)
+        if m:
+            events[(m.group(1), int(m.group(2)))][m.group(3)] = value
+    out = []
+    for (kind, _), d in events.items():
+        if not d.get("id"):
+            continue
+        updated = int(d.get("updated_at") or d.get("last_modified") or 0)
+        if kind == "delete":
+            # повтор удаления ничего не меняет, а терять удаление без времени нельзя
+            out.append(_Lead({"id": d["id"], "updated_at": updated or int(time.time())}))
+            continue
+        if not updated:
+            continue
+        status_id = int(d.get("status_id") or 0)
+        closed = int(d.get("closed_at") or 0)
+        if (not closed and kind == "status" and status_id in (WON_STATUS_ID, LOST_STATUS_ID)
+                and int(d.get("old_status_id") or 0) != status_id):
+            closed = updated
+        out.append(_Lead({
+            "id": d["id"],
+            "status_id": status_id,
+            "responsible_user_id": d.get("responsible_user_id"),
+            "price": d.get("price"),
+            "created_at": d.get("created_at") or d.get("date_create"),
+            "closed_at": closed,
+            "updated_at": updated,
+        }))
+    # status и update об одном лиде в одной доставке: смена статуса (с closed_at) главнее
+    best: Dict[int, _Lead] = {}
+    for lead in out:
+        prev = best.get(lead.id)
+        if prev is None or (lead.updated_at, lead.closed_at) > (prev.updated_at, prev.closed_at):
+            best[lead.id] = lead
+    return list(best.values())
+
+def _webhook_enqueue(app, company_id: int, leads: list) -> int:
+    """
+    Кладёт лиды в буфер компании. Повторная доставка (тот же лид, updated_at, статус и ответственный)
+    отбрасывается. Буфер сбрасывается одной пачкой через AMO_WEBHOOK_FLUSH_SEC. Возвращает число принятых.
+    """
+    global _webhook_flush_pending
+    accepted = 0
+    with _webhook_lock:
+        for lead in leads:
+            key = (company_id, lead.id)
+            sig = (lead.updated_at, lead.status_id, lead.responsible_user_id, lead.closed_at)
+            if _webhook_seen.get(key) == sig:
+                continue
+            _webhook_seen[key] = sig
+            _webhook_seen.move_to_end(key)
+            prev = _webhook_buf[company_id].get(lead.id)
+            if prev is None or (lead.updated_at, lead.closed_at) >= (prev.updated_at, prev.closed_at):
+                _webhook_buf[company_id][lead.id] = lead
+            accepted += 1
+        while len(_webhook_seen) > _WEBHOOK_SEEN_MAX:
+            _webhook_seen.popitem(last=False)
+        if accepted and not _webhook_flush_pending:
+            _webhook_flush_pending = True
+            _webhook_pool.submit(_flush_webhooks, app)
+    return accepted
+
+def _webhook_requeue(app, company_id: int, leads: list) -> None:
+    """Компанию сейчас пишет синк — возвращаем пачку в буфер (не затирая более свежие версии) до следующего сброса."""
+    global _webhook_flush_pending
+    with _webhook_lock:
+        buf = _webhook_buf[company_id]
+        for lead in leads:
+            prev = buf.get(lead.id)
+            if prev is None or (lead.updated_at, lead.closed_at) > (prev.updated_at, prev.closed_at):
+                buf[lead.id] = lead
+        if not _webhook_flush_pending:
+            _webhook_flush_pending = True
+            _webhook_pool.submit(_flush_webhooks, app)
+
+def _flush_webhooks(app) -> None:
+    """Применяет накопленные вебхуки: amocrm_metrics_daily (через amocrm_lead_state), «сегодня», сброс кэша."""
+    global _webhook_flush_pending
+    time.sleep(AMO_WEBHOOK_FLUSH_SEC)
+    with _webhook_lock:
+        batch = {cid: list(leads.values()) for cid, leads in _webhook_buf.items() if leads}
+        _webhook_buf.clear()
+        _webhook_flush_pending = False
+
+    now = int(time.time())
+    with app.app_context():
+        for company_id, leads in batch.items():
+            if AmoLeadState is not None and AmoSyncCursor is not None:
+                lease = _SyncLease(company_id)
+                if not lease.acquire():
+                    _webhook_requeue(app, company_id, leads)
+                    continue
+                try:
+                    changed = _apply_leads_page(company_id, leads)
+                    db.session.commit()
+                    log.info("AMO webhook company=%s: %d leads, %d changed", company_id, len(leads), changed)
+                except Exception:
+                    db.session.rollback()
+                    log.exception("AMO webhook apply company=%s failed, polling will reconcile", company_id)
+                finally:
+                    lease.release()
+            st = _today.get(company_id)
+            if st and st.cursor and st.midnight == _local_midnight(now):
+                with st.lock:
+                    for lead in leads:
+                        st.apply(lead)
+                    st.pushed_at = now
+            _result_cache.invalidate(company_id)
+
+
 # ======== API ========
 
+@bp_amocrm_company_api.errorhandler(AmoRateLimited)
+def _amo_rate_limited(e):
+    resp = jsonify({"error": "amoCRM rate limit, try again shortly"})
+    resp.status_code = 429
+    resp.headers["Retry-After"] = "5"
+    return resp
+
+def _amo_fetch_failed(company_id: int, e: requests.RequestException):
+    """Загрузка для кэша не удалась: 503 — если ждали чужую загрузку, 502 — если упал свой запрос в amoCRM."""
+    log.warning("AMO fetch company=%s failed: %r", company_id, e)
+    if isinstance(e, AmoFetchUnavailable):
+        resp = jsonify({"error": "amoCRM data temporarily unavailable, try again shortly"})
+        resp.status_code = 503
+        resp.headers["Retry-After"] = "5"
+        return resp
+    return jsonify({"error": "amoCRM request failed"}), 502
+
 @bp_amocrm_company_api.get("/<int:company_id>/crm/amocrm/status")
 def amocrm_status(company_id: int):
     tok = _refresh_if_needed(company_id)
     if not tok:
         return jsonify({"connected": False})
-    return jsonify({
+    out = {
         "connected": True,
         "base_domain": tok.get("base_domain"),
         "token_expires_at": tok.get("expires_at"),
         "last_sync_at": tok.get("last_sync_at"),
-    })
+    }
+    if g.get("amo_company_owner"):
+        out["webhook_url"] = _webhook_url(company_id)  # секрет: менеджерам компании не показываем
+    return jsonify(out)
 
 @bp_amocrm_company_api.post("/<int:company_id>/crm/amocrm/unlink")
 def amocrm_unlink(company_id: int):
@@ -483,7 +1693,6 @@ def amocrm_callback(company_id: int):
     except Exception:
         return "Bad state", 400
 
-    token_url = f"https://{dom}/oauth2/access_token"
     data = {
         "client_id": AMO_CLIENT_ID,
         "client_secret": AMO_CLIENT_SECRET,
@@ -492,7 +1701,7 @@ def amocrm_callback(company_id: int):
         "redirect_uri": _callback_url(company_id),
     }
     try:
-        r = requests.post(token_url, json=data, timeout=15)
+        r = _amo_request("POST", dom, "/oauth2/access_token", json_body=data, timeout=15)
         if r.status_code != 200:
             current_app.logger.error("AMO token exchange failed: %s %s", r.status_code, r.text)
             return "Token exchange failed", 400
@@ -511,6 +1720,9 @@ def amocrm_sync(company_id: int):
     tok = _read_tokens(company_id)
     if not tok:
         return jsonify({"error": "not connected"}), 400
+    if AmoConnection is not None:
+        queue_sync(current_app._get_current_object(), company_id)
+        return jsonify({"ok": True, "queued": True}), 202
     if Company and db:
         c = _get_company(company_id)
         if c and hasattr(c, "amo_last_sync_at"):
@@ -522,6 +1734,26 @@ def amocrm_sync(company_id: int):
         session[_session_key(company_id)] = tok
     return jsonify({"ok": True})
 
+@bp_amocrm_company_api.post("/<int:company_id>/crm/amocrm/webhook/<token>")
+def amocrm_webhook(company_id: int, token: str):
+    """
+    Приёмник вебхуков amoCRM (сделки: добавлена/изменена/смена статуса/ответственного/удалена).
+    Источник проверяется секретным токеном в URL (_webhook_url) и обязательным поддоменом аккаунта.
+    Отвечаем сразу, применение — пачкой в фоне.
+    """
+    if not hmac.compare_digest(token, _webhook_token(company_id)):
+        return jsonify({"error": "not found"}), 404
+    tok = _read_tokens(company_id)
+    if not tok or not tok.get("base_domain"):
+        return jsonify({"error": "not connected"}), 404
+    subdomain = (request.form.get("account[subdomain]") or "").strip().lower()
+    if not subdomain or subdomain != tok["base_domain"].split(".")[0].lower():
+        return jsonify({"error": "account mismatch"}), 403
+
+    leads = _leads_from_webhook(request.form)
+    accepted = _webhook_enqueue(current_app._get_current_object(), company_id, leads) if leads else 0
+    return jsonify({"ok": True, "received": len(leads), "accepted": accepted})
+
 @bp_amocrm_company_api.get("/<int:company_id>/crm/stats")
 def crm_stats(company_id: int):
     tok = _refresh_if_needed(company_id)
@@ -534,21 +1766,15 @@ def crm_stats(company_id: int):
         return jsonify({"error": "not connected"}), 400
 
     ts_from, ts_to, days, label = _period_from_request()
-    data = _compute_stats(base_domain, access_token, ts_from, ts_to)
-
-    total_all = data["won_count"] + data["lost_count"]
-    conversion = round(100 * data["won_count"] / total_all) if total_all else 0
-
-    return jsonify({
-        "range": label,
-        "from": ts_from,
-        "to": ts_to,
-        "days": days,
-        "won_count": data["won_count"],
-        "lost_count": data["lost_count"],
-        "conversion": conversion,
-        "by_user": data["rows"],
-    })
+    try:
+        payload, state = _cached_stats(company_id, tok, ts_from, ts_to, days, label)
+    except AmoRateLimited:
+        raise
+    except requests.RequestException as e:
+        return _amo_fetch_failed(company_id, e)
+    resp = jsonify(payload)
+    resp.headers["X-Cache"] = state
+    return resp
 
 @bp_amocrm_company_api.get("/<int:company_id>/crm/stats.xlsx")
 def crm_stats_xlsx(company_id: int):
@@ -562,7 +1788,12 @@ def crm_stats_xlsx(company_id: int):
         return jsonify({"error": "not connected"}), 400
 
     ts_from, ts_to, days, label = _period_from_request()
-    base = _compute_stats(base_domain, access_token, ts_from, ts_to)
+    try:
+        base, _ = _cached_stats(company_id, tok, ts_from, ts_to, days, label)
+    except AmoRateLimited:
+        raise
+    except requests.RequestException as e:
+        return _amo_fetch_failed(company_id, e)
 
     sort = request.args.get("sort", "won_desc")
     try:
@@ -571,7 +1802,7 @@ def crm_stats_xlsx(company_id: int):
         min_total = 0
     q = request.args.get("q", "").strip()
 
-    rows = _apply_view_filters(list(base["rows"]), sort, min_total, q)
+    rows = _apply_view_filters(list(base["by_user"]), sort, min_total, q)
     total_won = sum(r["won"] for r in rows)
     total_lost = sum(r["lost"] for r in rows)
     total_all = total_won + total_lost
@@ -596,81 +1827,84 @@ def crm_stats_xlsx(company_id: int):
             download_name=f"crm_stats_company_{company_id}_{filename_label}.csv",
         )
 
-    # XLSX (красиво оформленный)
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Статистика"
+    # XLSX (красиво оформленный), write-only: строки пишутся сразу в файл, без дерева ячеек в памяти
+    period = f"Период: {'сегодня' if label=='today' else f'последние {days} дней' if days else 'задан вручную'}"
+    made = f"Сформировано: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}"
+    headers = ["ID", "Пользователь", "Успешно", "Не реализовано", "Конверсия"]
 
-    ws["A1"] = "Статистика по сотрудникам"
-    ws["A2"] = f"Период: {'сегодня' if label=='today' else f'последние {days} дней' if days else 'задан вручную'}"
-    ws["A3"] = f"Сформировано: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())}"
-    ws.merge_cells("A1:E1")
-    ws.merge_cells("A2:E2")
-    ws.merge_cells("A3:E3")
+    def data_rows():
+        for r in rows:
+            yield [r["user_id"], r["display_name"], r["won"], r["lost"], r["conv"] / 100]
+
+    # ширины колонок — одним проходом по шапке, данным и итогу (в write-only их надо задать до
+    # первой строки). Заголовок/период/«Сформировано» не меряем: merge_cells в write-only нет, и
+    # вместо объединения A:E текст просто выходит в пустые соседние ячейки — иначе колонка ID
+    # растягивалась бы под длину заголовка
+    widths = [0] * 5
+    for values in itertools.chain(
+        [headers, ["ИТОГО:", None, total_won, total_lost, conv_overall / 100]],
+        data_rows(),
+    ):
+        for col, v in enumerate(values):
+            if v is not None:
+                widths[col] = max(widths[col], len(str(v)))
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Статистика")
+    for col, w in enumerate(widths, start=1):
+        ws.column_dimensions[chr(64 + col)].width = min(w + 2, 50)
+    ws.freeze_panes = "A6"
+
+    def cell(value, **style):
+        c = WriteOnlyCell(ws, value=value)
+        for k, v in style.items():
+            setattr(c, k, v)
+        return c
 
     title_font = Font(size=14, bold=True)
     sub_font = Font(size=10, color="666666")
-    ws["A1"].font = title_font
-    ws["A2"].font = sub_font
-    ws["A3"].font = sub_font
-
-    headers = ["ID", "Пользователь", "Успешно", "Не реализовано", "Конверсия"]
-    start_row = 5
-    for col, h in enumerate(headers, start=1):
-        cell = ws.cell(row=start_row, column=col, value=h)
-        cell.font = Font(bold=True, color="FFFFFF")
-        cell.alignment = Alignment(horizontal="center", vertical="center")
-        cell.fill = PatternFill("solid", fgColor="6D5CF7")
-        cell.border = Border(
+    bold = Font(bold=True)
+    head_style = {
+        "font": Font(bold=True, color="FFFFFF"),
+        "alignment": Alignment(horizontal="center", vertical="center"),
+        "fill": PatternFill("solid", fgColor="6D5CF7"),
+        "border": Border(
             left=Side(style="thin", color="DDDDDD"),
             right=Side(style="thin", color="DDDDDD"),
             top=Side(style="thin", color="DDDDDD"),
             bottom=Side(style="thin", color="DDDDDD"),
-        )
-
+        ),
+    }
+    row_border = Border(
+        left=Side(style="thin", color="EEEEEE"),
+        right=Side(style="thin", color="EEEEEE"),
+        top=Side(style="thin", color="EEEEEE"),
+        bottom=Side(style="thin", color="EEEEEE"),
+    )
     zebra = PatternFill("solid", fgColor="F7F8FC")
-    for i, r in enumerate(rows, start=1):
-        row_i = start_row + i
-        ws.cell(row=row_i, column=1, value=r["user_id"])
-        ws.cell(row=row_i, column=2, value=r["display_name"])
-        ws.cell(row=row_i, column=3, value=r["won"])
-        ws.cell(row=row_i, column=4, value=r["lost"])
-        conv_cell = ws.cell(row=row_i, column=5, value=(r["conv"] / 100))
-        conv_cell.number_format = "0%"
-        for c in range(1, 6):
-            cell = ws.cell(row=row_i, column=c)
-            cell.border = Border(
-                left=Side(style="thin", color="EEEEEE"),
-                right=Side(style="thin", color="EEEEEE"),
-                top=Side(style="thin", color="EEEEEE"),
-                bottom=Side(style="thin", color="EEEEEE"),
-            )
-            if i % 2 == 0:
-                cell.fill = zebra
-
-    total_row = start_row + len(rows) + 2
-    ws.cell(row=total_row, column=1, value="ИТОГО:").font = Font(bold=True)
-    ws.cell(row=total_row, column=3, value=total_won).font = Font(bold=True)
-    ws.cell(row=total_row, column=4, value=total_lost).font = Font(bold=True)
-    c_over = ws.cell(row=total_row, column=5, value=(conv_overall / 100))
-    c_over.number_format = "0%"
-    c_over.font = Font(bold=True)
-
-    ws.freeze_panes = ws["A6"]
-    for col in range(1, 6):
-        max_len = 0
-        for row in range(1, ws.max_row + 1):
-            v = ws.cell(row=row, column=col).value
-            if v is None:
-                continue
-            max_len = max(max_len, len(str(v)))
-        ws.column_dimensions[chr(64 + col)].width = min(max_len + 2, 50)
 
-    bio = io.BytesIO()
-    wb.save(bio)
-    bio.seek(0)
+    ws.append([cell("Статистика по сотрудникам", font=title_font)])
+    ws.append([cell(period, font=sub_font)])
+    ws.append([cell(made, font=sub_font)])
+    ws.append([])
+    ws.append([cell(h, **head_style) for h in headers])
+    for i, values in enumerate(data_rows(), start=1):
+        style = {"border": row_border, "fill": zebra} if i % 2 == 0 else {"border": row_border}
+        out = [cell(v, **style) for v in values]
+        out[4].number_format = "0%"
+        ws.append(out)
+    ws.append([])
+    ws.append([
+        cell("ИТОГО:", font=bold), None,
+        cell(total_won, font=bold), cell(total_lost, font=bold),
+        cell(conv_overall / 100, font=bold, number_format="0%"),
+    ])
+
+    tmp = tempfile.TemporaryFile()
+    wb.save(tmp)
+    tmp.seek(0)
     return send_file(
-        bio,
+        tmp,
         mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         as_attachment=True,
         download_name=fname,
@@ -681,15 +1915,11 @@ def crm_users(company_id: int):
     tok = _refresh_if_needed(company_id)
     if not tok:
         return jsonify({"connected": False})
+    force = (request.args.get("refresh") or "") in ("1", "true")
     users = []
     try:
-        base_domain = tok.get("base_domain")
-        url = f"https://{base_domain}/api/v4/users"
-        r = requests.get(url, headers=_amo_headers(tok["access_token"]), timeout=15)
-        if r.status_code == 200:
-            data = r.json()
-            for u in data.get("_embedded", {}).get("users", []):
-                users.append({"id": u.get("id"), "name": u.get("name"), "email": u.get("email")})
+        users_map = _users_directory(company_id, tok, force=force)
+        users = [{"id": u["id"], "name": u.get("name"), "email": u.get("email")} for u in users_map.values()]
     except requests.RequestException:
         current_app.logger.warning("AMO users fetch failed")
     return jsonify({"connected": True, "users": users})
@@ -716,32 +1946,33 @@ def crm_realtime(company_id: int):
     tok = _refresh_if_needed(company_id)
     if not tok:
         return jsonify({"error": "not connected"}), 400
-
-    base_domain = tok.get("base_domain")
-    access_token = tok.get("access_token")
-    if not base_domain or not access_token:
+    if not tok.get("base_domain") or not tok.get("access_token"):
         return jsonify({"error": "not connected"}), 400
 
+    try:
+        payload, state = _result_cache.get(
+            (company_id, "rt", "today"),
+            lambda: _realtime_payload(company_id, _refresh_if_needed(company_id) or tok),
+            ttl=AMO_RT_CACHE_TTL_SEC,
+        )
+    except AmoRateLimited:
+        raise
+    except requests.RequestException as e:
+        return _amo_fetch_failed(company_id, e)
+    resp = jsonify(payload)
+    resp.headers["X-Cache"] = state
+    return resp
+
+def _realtime_payload(company_id: int, tok: Dict[str, Any]) -> Dict[str, Any]:
     now = int(time.time())
-    lt = time.localtime(now)
-    midnight = int(time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday, 0, 0, 0, lt.tm_wday, lt.tm_yday, lt.tm_isdst)))
+    st = _today_counters(company_id, tok, now)
+    midnight = st.midnight
+    with st.lock:
+        won_by = {u: n for u, n in st.won.items() if n}
+        lost_by = {u: n for u, n in st.lost.items() if n}
+        created_by = {u: n for u, n in st.created.items() if n}
 
-    won_by = defaultdict(int)
-    lost_by = defaultdict(int)
-    for lead in _iter_closed_leads(base_domain, access_token, midnight, now):
-        uid = lead.get("responsible_user_id") or 0
-        sid = int(lead.get("status_id") or 0)
-        if sid == WON_STATUS_ID:
-            won_by[uid] += 1
-        elif sid == LOST_STATUS_ID:
-            lost_by[uid] += 1
-
-    created_by = defaultdict(int)
-    for lead in _iter_created_leads(base_domain, access_token, midnight, now):
-        uid = lead.get("responsible_user_id") or 0
-        created_by[uid] += 1
-
-    users_map = _fetch_users_map(base_domain, access_token)  # id->{name,email}
+    users_map = _users_directory(company_id, tok)  # id->{name,email}
 
     total_won = sum(won_by.values())
     total_lost = sum(lost_by.values())
@@ -774,7 +2005,7 @@ def crm_realtime(company_id: int):
 
     per_user.sort(key=lambda r: (-r["won"], -r["conv"], -r["created"]))
 
-    return jsonify({
+    return {
         "range": "today",
         "from": midnight,
         "to": now,
@@ -786,7 +2017,7 @@ def crm_realtime(company_id: int):
             "conversion_today": conversion,
         },
         "users": per_user,
-    })
+    }
 
 
 # ===== Pages =====
@@ -2,22 +2,24 @@
 import os
 import json
 import uuid
+import time
 from datetime import datetime, timedelta, date
 from functools import wraps
 from typing import Optional, Dict, Any
 from werkzeug.exceptions import HTTPException
-import requests  # для _send_telegram_messageimport requests  # для _send_telegram_message
 
 from flask import (
-    Flask, request, jsonify, session, redirect, url_for, abort, render_template, make_response
+    Flask, request, jsonify, session, redirect, url_for, abort, render_template, make_response,
+    Response, stream_with_context, g
 )
 
 from flask_sqlalchemy import SQLAlchemy  # можно оставить
-from extensions import db  # <-- добавили
+from extensions import db, scheduler  # <-- добавили
 
-from sqlalchemy import UniqueConstraint, Index, func, and_, or_, text
+from sqlalchemy import UniqueConstraint, Index, func, and_, or_, text, select, event, update, delete, bindparam, case
+from sqlalchemy.orm import Session as OrmSession
 from werkzeug.security import generate_password_hash, check_password_hash
-import pathlib, hashlib, re
+import pathlib, hashlib, re, base64
 import random, string, secrets
 # Регистрация CRM-блюпринта после инициализации приложения
 
@@ -36,6 +38,8 @@ SECRET_KEY = os.getenv("SECRET_KEY", "dev_secret_change_me")
 SESSION_COOKIE_NAME = "salesjourney"
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 TELEGRAM_BOT_USERNAME = os.getenv("TELEGRAM_BOT_USERNAME", "")
+# какие типы Notification дублировать в Telegram (пусто — все)
+TELEGRAM_NOTIFY_TYPES = {t.strip() for t in os.getenv("TELEGRAM_NOTIFY_TYPES", "").split(",") if t.strip()}
 
 app.config.update(
     SQLALCHEMY_DATABASE_URI=DATABASE_URL,
@@ -54,6 +58,13 @@ app.logger.warning("DB FILE -> %s", DB_FILE)
 db.init_app(app)
 # Регистрация CRM-блюпринта ПОСЛЕ создания app и db.init_app(app)
 from amocrm_integration import bp_amocrm_company_api, bp_amocrm_pages
+import amocrm_integration
+import telegram_outbox
+from telegram_outbox import outbox as tg_outbox
+from notify_hub import hub as notify_hub, capacity as notify_stream_capacity
+import bot_control
+
+tg_outbox.init_app(app)
 
 ASSETS_DIR = pathlib.Path("static/avatars/layers")  # как выше в структуре
 
@@ -82,17 +93,20 @@ def current_admin():
 
 # --- Telegram helpers ---
 def _send_telegram_message(chat_id: str, text: str, parse_mode: str = "HTML") -> bool:
+    """
+    Ставит сообщение в telegram_outbox отдельной короткой транзакцией (сессию вызывающего
+    не коммитит); отправка — воркерами, не в запросе. False — если доставлять некому.
+    """
     if not TELEGRAM_BOT_TOKEN or not chat_id:
         return False
-    try:
-        r = requests.post(
-            f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
-            json={"chat_id": chat_id, "text": text, "parse_mode": parse_mode, "disable_web_page_preview": True},
-            timeout=10,
-        )
-        return r.ok
-    except Exception:
+    if not tg_outbox.delivering:
+        app.logger.warning("Telegram outbox is not running, message to %s dropped", chat_id)
         return False
+    with db.engine.begin() as conn:
+        conn.execute(telegram_outbox.TelegramOutbox.__table__.insert(),
+                     telegram_outbox.outbox_row(chat_id, text, parse_mode=parse_mode))
+    tg_outbox.wake()
+    return True
 
 def _gen_tg_code(length: int = 6) -> str:
     alphabet = string.ascii_uppercase + string.digits
@@ -235,6 +249,9 @@ class User(db.Model):
     tg_link_code_created_at = db.Column(db.DateTime, nullable=True)
     tg_linked_at            = db.Column(db.DateTime, nullable=True)
 
+    # счётчик непрочитанных Notification (ведётся хуком вставки, сверяется фоновым джобом)
+    unread_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
     company = db.relationship("Company", back_populates="members_rel", lazy="joined")
     avatar  = db.relationship("UserAvatar", back_populates="user", uselist=False, cascade="all, delete-orphan")
 
@@ -555,6 +572,7 @@ class PartnerUser(db.Model):
     password    = db.Column(db.String(255), nullable=False)
     display_name= db.Column(db.String(100), nullable=False)
     created_at  = db.Column(db.DateTime, default=now_utc)
+    unread_count= db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
 # ------------------ Training module ------------------
 class TrainingCourse(db.Model):
@@ -639,6 +657,7 @@ class CompanyTask(db.Model):
     points_xp   = db.Column(db.Integer, nullable=False, default=20)
     coins       = db.Column(db.Integer, nullable=False, default=5)
     due_at      = db.Column(db.DateTime, nullable=True)
+    due_notified_at = db.Column(db.DateTime, nullable=True)  # когда разослали task_due (NULL — ещё не рассылали)
     is_active   = db.Column(db.Boolean, nullable=False, default=True)
 
     # НОВОЕ:
@@ -651,6 +670,9 @@ class CompanyTask(db.Model):
     created_by_user_id    = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=True)
     created_at  = db.Column(db.DateTime, default=now_utc)
 
+    # индекс «ближайших» дедлайнов: WHERE due_notified_at IS NULL → MIN(due_at)
+    __table_args__ = (Index("ix_company_tasks_due_pending", "due_notified_at", "due_at"),)
+
     company = db.relationship("Company", lazy="joined")
     partner = db.relationship("PartnerUser", lazy="joined")
     creator_user = db.relationship("User", foreign_keys=[created_by_user_id], lazy="joined")
@@ -666,7 +688,11 @@ class CompanyTaskAssign(db.Model):
     submitted_at= db.Column(db.DateTime, nullable=True)
     completed_at= db.Column(db.DateTime, nullable=True)
 
-    __table_args__ = (UniqueConstraint('task_id','user_id', name='uq_task_user'),)
+    __table_args__ = (
+        UniqueConstraint('task_id','user_id', name='uq_task_user'),
+        # очередь отчётов: фильтр по статусу + keyset по (submitted_at, id)
+        Index("ix_task_assign_status_submitted", "status", "submitted_at", "id"),
+    )
 
     task = db.relationship("CompanyTask", lazy="joined")
     user = db.relationship("User", lazy="joined")
@@ -683,6 +709,26 @@ class Notification(db.Model):
     is_read    = db.Column(db.Boolean, nullable=False, default=False)
     created_at = db.Column(db.DateTime, default=now_utc)
 
+    __table_args__ = (
+        # лента «последние 50» — диапазонный проход по индексу без сортировки
+        Index("ix_notifications_user_created", "user_id", "created_at"),
+        Index("ix_notifications_partner_created", "partner_id", "created_at"),
+    )
+
+class NotificationArchive(db.Model):
+    """Помесячные агрегаты удалённых (прочитанных и старых) уведомлений."""
+    __tablename__ = "notifications_archive"
+    id         = db.Column(db.Integer, primary_key=True)
+    month      = db.Column(db.String(7), nullable=False)  # YYYY-MM
+    user_id    = db.Column(db.Integer, nullable=True)
+    partner_id = db.Column(db.Integer, nullable=True)
+    type       = db.Column(db.String(32), nullable=False)
+    count      = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index("ix_notif_archive_key", "month", "user_id", "partner_id", "type"),
+    )
+
 class CompanyTaskSubmission(db.Model):
     __tablename__ = "company_task_submissions"
     id          = db.Column(db.Integer, primary_key=True)
@@ -693,6 +739,8 @@ class CompanyTaskSubmission(db.Model):
     comment     = db.Column(db.Text, nullable=True)
     submitted_at= db.Column(db.DateTime, default=now_utc)
 
+    __table_args__ = (Index("ix_task_sub_assign_time", "assign_id", "submitted_at"),)
+
 
 class TrainingAttempt(db.Model):
     __tablename__ = "training_attempts"
@@ -815,6 +863,75 @@ class InterviewInvite(db.Model):
     assignment_text   = db.Column(db.Text, nullable=True)
     attachments_json  = db.Column(db.Text, nullable=True)
 
+# -----------------------------------------------------------------------------
+# Notification hooks
+# -----------------------------------------------------------------------------
+# Любая вставка Notification (по одной или пачкой через add_all) проходит через flush:
+# здесь же, в той же транзакции, ставим Telegram-доставку для привязанных пользователей.
+@event.listens_for(OrmSession, "after_flush")
+def _notifications_after_flush(session, flush_context):
+    new = [o for o in session.new if isinstance(o, Notification)]
+    if not new:
+        return
+    conn = session.connection()
+
+    # для SSE-хаба: последний id на адресата, публикуется только после коммита
+    pub = session.info.setdefault("notify_publish", {})
+    for n in new:
+        for key in (("u", n.user_id), ("p", n.partner_id)):
+            if key[1] and n.id > pub.get(key, 0):
+                pub[key] = n.id
+
+    # unread_count: один UPDATE на адресата, сколько бы уведомлений ни пришло пачкой
+    for model, attr in ((User, "user_id"), (PartnerUser, "partner_id")):
+        inc: Dict[int, int] = {}
+        for n in new:
+            rid = getattr(n, attr)
+            if rid and not n.is_read:
+                inc[rid] = inc.get(rid, 0) + 1
+        if inc:
+            t = model.__table__
+            conn.execute(
+                update(t).where(t.c.id == bindparam("rid")).values(unread_count=t.c.unread_count + bindparam("n")),
+                [{"rid": rid, "n": n} for rid, n in inc.items()],
+            )
+
+    if TELEGRAM_BOT_TOKEN:
+        tg_new = [n for n in new if n.user_id and (not TELEGRAM_NOTIFY_TYPES or n.type in TELEGRAM_NOTIFY_TYPES)]
+        uids = {n.user_id for n in (new if bot_control.ENABLED else tg_new) if n.user_id}
+        chats = dict(conn.execute(
+            select(User.id, User.telegram_chat_id)
+            .where(User.id.in_(uids), User.telegram_chat_id.isnot(None))
+        ).all()) if uids else {}
+        if chats and bot_control.ENABLED:
+            # у бота закэширована сводка этих чатов — после коммита попросим её сбросить
+            session.info.setdefault("bot_invalidate", set()).update(chats.values())
+        if tg_new:
+            rows = [telegram_outbox.outbox_row(
+                        chats[n.user_id], telegram_outbox.format_notification(n.title, n.body),
+                        notification_id=n.id, kind=n.type)
+                    for n in tg_new if chats.get(n.user_id)]
+            if rows:
+                conn.execute(telegram_outbox.TelegramOutbox.__table__.insert(), rows)
+                session.info["tg_outbox_dirty"] = True
+
+@event.listens_for(OrmSession, "after_commit")
+def _notifications_after_commit(session):
+    if session.info.pop("tg_outbox_dirty", False):
+        tg_outbox.wake()
+    pub = session.info.pop("notify_publish", None)
+    if pub:
+        notify_hub.publish(pub.items())
+    chats = session.info.pop("bot_invalidate", None)
+    if chats:
+        bot_control.invalidate(chats)
+
+@event.listens_for(OrmSession, "after_rollback")
+def _notifications_after_rollback(session):
+    session.info.pop("tg_outbox_dirty", None)
+    session.info.pop("notify_publish", None)
+    session.info.pop("bot_invalidate", None)
+
 # -----------------------------------------------------------------------------
 # DB bootstrap
 # -----------------------------------------------------------------------------
@@ -1088,10 +1205,40 @@ with app.app_context():
             db.session.execute(text('ALTER TABLE company_tasks ADD COLUMN reward_item_payload TEXT'))
         except Exception:
             pass
+        try:
+            db.session.execute(text('ALTER TABLE company_tasks ADD COLUMN due_notified_at DATETIME'))
+            # старые просроченные задачи не рассылаем задним числом
+            db.session.execute(text(
+                'UPDATE company_tasks SET due_notified_at = due_at WHERE due_at IS NOT NULL AND due_at <= CURRENT_TIMESTAMP'))
+        except Exception:
+            pass
+        try:
+            db.session.execute(text(
+                'CREATE INDEX IF NOT EXISTS ix_company_tasks_due_pending ON company_tasks (due_notified_at, due_at)'))
+        except Exception:
+            pass
         try:
             db.session.execute(text('ALTER TABLE company_task_assigns ADD COLUMN submitted_at DATETIME'))
         except Exception:
             pass
+        try:
+            db.session.execute(text(
+                'CREATE INDEX IF NOT EXISTS ix_task_assign_status_submitted '
+                'ON company_task_assigns (status, submitted_at, id)'))
+            db.session.execute(text(
+                'CREATE INDEX IF NOT EXISTS ix_task_sub_assign_time '
+                'ON company_task_submissions (assign_id, submitted_at)'))
+        except Exception:
+            pass
+        try:
+            db.session.execute(text(
+                'CREATE INDEX IF NOT EXISTS ix_notifications_user_created '
+                'ON notifications (user_id, created_at)'))
+            db.session.execute(text(
+                'CREATE INDEX IF NOT EXISTS ix_notifications_partner_created '
+                'ON notifications (partner_id, created_at)'))
+        except Exception:
+            pass
         try:
             db.session.execute(text('ALTER TABLE company_task_assigns RENAME COLUMN status TO status'))
         except Exception:
@@ -1129,6 +1276,68 @@ with app.app_context():
         except Exception:
             pass
 
+        for tbl in ("users", "partner_users"):
+            try:
+                db.session.execute(text(f'ALTER TABLE {tbl} ADD COLUMN unread_count INTEGER NOT NULL DEFAULT 0'))
+                db.session.execute(text(
+                    f'UPDATE {tbl} SET unread_count = (SELECT COUNT(*) FROM notifications n '
+                    f'WHERE n.{"user_id" if tbl == "users" else "partner_id"} = {tbl}.id AND n.is_read = 0)'))
+            except Exception:
+                pass
+
+        try:
+            db.session.execute(text('ALTER TABLE telegram_outbox ADD COLUMN kind VARCHAR(32)'))
+        except Exception:
+            pass
+
+        # amocrm_connections из старого upgrade(): NOT NULL токены, DATETIME вместо epoch, нет token_type.
+        # create_all() существующую таблицу не меняет — пересобираем под модель AmoConnection.
+        amo_cols = {r[1] for r in db.session.execute(text("PRAGMA table_info(amocrm_connections)"))}
+        if amo_cols and "token_type" not in amo_cols:
+            try:
+                _epoch = ("CASE WHEN typeof({c}) IN ('integer', 'real') THEN CAST({c} AS INTEGER) "
+                          "ELSE CAST(strftime('%s', {c}) AS INTEGER) END")
+                db.session.execute(text(
+                    'CREATE TABLE amocrm_connections_new ('
+                    'id INTEGER NOT NULL PRIMARY KEY, company_id INTEGER NOT NULL, '
+                    'base_domain VARCHAR(255), access_token TEXT, refresh_token TEXT, '
+                    'token_type VARCHAR(32), expires_at INTEGER, last_sync_at INTEGER)'))
+                db.session.execute(text(
+                    'INSERT INTO amocrm_connections_new '
+                    '(id, company_id, base_domain, access_token, refresh_token, expires_at, last_sync_at) '
+                    'SELECT id, company_id, base_domain, access_token, refresh_token, '
+                    f'{_epoch.format(c="expires_at")}, {_epoch.format(c="last_sync_at")} FROM amocrm_connections'))
+                db.session.execute(text('DROP TABLE amocrm_connections'))
+                db.session.execute(text('ALTER TABLE amocrm_connections_new RENAME TO amocrm_connections'))
+                db.session.execute(text(
+                    'CREATE UNIQUE INDEX IF NOT EXISTS ix_amocrm_connections_company_id '
+                    'ON amocrm_connections (company_id)'))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                app.logger.exception("amocrm_connections migration failed")
+        try:
+            db.session.execute(text(
+                'CREATE UNIQUE INDEX IF NOT EXISTS uq_metrics_scope '
+                'ON amocrm_metrics_daily (company_id, amocrm_user_id, date)'))
+            db.session.execute(text(
+                'CREATE INDEX IF NOT EXISTS ix_amo_metrics_company_date ON amocrm_metrics_daily (company_id, date)'))
+        except Exception:
+            pass
+        # amocrm_sync_cursor из старого upgrade(): только updated_since, да и тот DATETIME.
+        for col in ("backfill_from INTEGER", "last_run_at INTEGER", "last_error VARCHAR(255)", "lock_until INTEGER"):
+            try:
+                db.session.execute(text(f'ALTER TABLE amocrm_sync_cursor ADD COLUMN {col}'))
+            except Exception:
+                pass
+        try:
+            # курсор-дата без backfill_from — агрегатам не верим, следующий синк сделает полный бэкфилл
+            db.session.execute(text(
+                "UPDATE amocrm_sync_cursor SET updated_since = NULL "
+                "WHERE typeof(updated_since) NOT IN ('integer', 'null') OR backfill_from IS NULL"))
+        except Exception:
+            pass
+
         # ←↓↓ новые миграции под онбординг v2
         try:
             db.session.execute(text('ALTER TABLE company_reg_steps ADD COLUMN is_active BOOLEAN DEFAULT 1'))
@@ -1377,28 +1586,54 @@ def company_manager_or_admin_required(f):
         )
         if cid <= 0:
             abort(400, description="company_id required")
-        c = db.session.get(Company, cid)
-        if not c:
-            abort(404, description="Company not found")
+        require_company_manager(cid)
+        return f(*args, **kwargs)
+    return wrapper
 
-        # 2) партнёр-владелец
-        p = current_partner()
-        if p:
-            if c.owner_partner_id != p.id:
-                abort(403)
-            return f(*args, **kwargs)
+def require_company_manager(cid: int) -> None:
+    """abort, если текущий сеанс — не партнёр-владелец и не admin/manager компании cid."""
+    c = db.session.get(Company, cid)
+    if not c:
+        abort(404, description="Company not found")
 
-        # 3) руководитель (admin/manager) этой компании
-        u = current_user()
-        if u:
-            cm = CompanyMember.query.filter_by(company_id=cid, user_id=u.id).first()
-            if cm and cm.role in ("admin", "manager"):
-                return f(*args, **kwargs)
+    # партнёр-владелец
+    p = current_partner()
+    if p:
+        if c.owner_partner_id != p.id:
             abort(403)
+        return
 
-        # 4) никто не залогинен
-        abort(401)
-    return wrapper
+    # руководитель (admin/manager) этой компании
+    u = current_user()
+    if u:
+        cm = CompanyMember.query.filter_by(company_id=cid, user_id=u.id).first()
+        if cm and cm.role in ("admin", "manager"):
+            return
+        abort(403)
+
+    # никто не залогинен
+    abort(401)
+
+# amoCRM-блюпринты живут в отдельном модуле без доступа к моделям app — доступ к ним проверяем
+# здесь, до view. Токены аккаунта лежат в БД по company_id, так что без проверки любой увидел бы
+# статистику/сотрудников чужой компании. Вебхук amoCRM проверяет себя сам (секрет в URL).
+# g.amo_company_owner — только партнёру-владельцу: ему одному отдаём секретный URL вебхука.
+AMOCRM_PUBLIC_ENDPOINTS = {"amocrm_company_api.amocrm_webhook"}
+
+@app.before_request
+def _amocrm_access_guard():
+    if request.blueprint not in (bp_amocrm_company_api.name, bp_amocrm_pages.name):
+        return None
+    if request.endpoint in AMOCRM_PUBLIC_ENDPOINTS:
+        return None
+    cid = safe_int((request.view_args or {}).get("company_id"), 0)
+    if cid <= 0:
+        abort(404)
+    if request.blueprint == bp_amocrm_pages.name and not (current_partner() or current_user()):
+        return redirect(url_for("page_partner_login"))
+    require_company_manager(cid)
+    g.amo_company_owner = current_partner() is not None
+    return None
 
 def current_reg_session_or_404():
     rid = _reg_session_id_from_request()
@@ -2406,6 +2641,7 @@ def api_tg_reset():
     u.telegram_chat_id = None
     u.tg_linked_at = None
     db.session.commit()
+    bot_control.invalidate([old_chat])
 
     if old_chat:
         _send_telegram_message(
@@ -2415,81 +2651,139 @@ def api_tg_reset():
         )
     return jsonify(ok=True)
 
-# Сервисный эндпоинт для бота: линк по коду
-@app.post("/api/telegram/bot/link")
-def api_tg_bot_link():
-    data = request.get_json(silent=True) or {}
-    code = (data.get("code") or "").strip().upper()
-    chat_id = str(data.get("chat_id") or "").strip()
-    tg_username = (data.get("username") or "").strip()
+# -----------------------------------------------------------------------------
+# Telegram bot services
+# -----------------------------------------------------------------------------
+# Логика бот-эндпоинтов без request/jsonify: её вызывают и HTTP-обёртки ниже,
+# и in-process адаптер bot.py (BOT_BACKEND=inprocess). Возвращают (payload, http_status).
+TG_BOT_SUMMARY_MAX = 20
+
+def _tg_notification_items(user_id: int, limit: int) -> list:
+    rows = (Notification.query
+            .filter_by(user_id=user_id)
+            .order_by(Notification.created_at.desc())
+            .limit(limit)
+            .all())
+    return [{
+        "id": n.id,
+        "type": n.type,
+        "title": n.title,
+        "body": n.body,
+        "created_at": n.created_at.isoformat(),
+        "is_read": n.is_read,
+    } for n in rows]
 
+def tg_bot_link(code: str, chat_id: str, username: str = "") -> tuple[dict, int]:
+    code = (code or "").strip().upper()
+    chat_id = str(chat_id or "").strip()
     if not code or not chat_id:
-        return jsonify(ok=False, error="EMPTY"), 400
+        return {"ok": False, "error": "EMPTY"}, 400
 
     u = User.query.filter_by(tg_link_code=code).first()
     if not u:
-        return jsonify(ok=False, error="CODE_NOT_FOUND"), 404
+        return {"ok": False, "error": "CODE_NOT_FOUND"}, 404
 
     # if u.tg_link_code_created_at and datetime.utcnow() - u.tg_link_code_created_at > timedelta(days=2):
-    #     return jsonify(ok=False, error="CODE_EXPIRED"), 410
+    #     return {"ok": False, "error": "CODE_EXPIRED"}, 410
 
     u.telegram_chat_id = chat_id
     u.tg_linked_at = datetime.utcnow()
     u.tg_link_code = None  # одноразовый
     db.session.commit()
+    bot_control.invalidate([chat_id])
 
     _send_telegram_message(chat_id, "✅ Привязка выполнена. Уведомления будут приходить в этот чат.")
-    return jsonify(ok=True, user_id=u.id, user=user_to_dict(u))
-
-@app.route("/api/telegram/bot/me", methods=["GET", "POST"])
-def api_tg_bot_me():
-    chat_id = (request.args.get("chat_id") or request.args.get("tg_chat_id") or "").strip()
-    if not chat_id and request.is_json:
-        j = request.get_json(silent=True) or {}
-        chat_id = (str(j.get("chat_id") or j.get("tg_chat_id") or "")).strip()
+    return {"ok": True, "user_id": u.id, "user": user_to_dict(u)}, 200
 
+def tg_bot_me(chat_id: str) -> tuple[dict, int]:
+    chat_id = str(chat_id or "").strip()
     if not chat_id:
-        return jsonify(ok=False, linked=False, error="EMPTY"), 400
-
+        return {"ok": False, "linked": False, "error": "EMPTY"}, 400
     u = User.query.filter_by(telegram_chat_id=chat_id).first()
     if not u:
-        return jsonify(ok=True, linked=False)
+        return {"ok": True, "linked": False}, 200
+    return {"ok": True, "linked": True, "user": user_to_dict(u)}, 200
 
-    return jsonify(ok=True, linked=True, user=user_to_dict(u))
+def tg_bot_notifications(chat_id: str, limit: int = 5) -> tuple[dict, int]:
+    chat_id = str(chat_id or "").strip()
+    if not chat_id:
+        return {"ok": False, "error": "EMPTY"}, 400
+    u = User.query.filter_by(telegram_chat_id=chat_id).first()
+    if not u:
+        return {"ok": True, "linked": False, "items": []}, 200
+    return {"ok": True, "linked": True, "user": user_to_dict(u),
+            "items": _tg_notification_items(u.id, limit)}, 200
 
-@app.route("/api/telegram/bot/notifications", methods=["GET", "POST"])
-def api_tg_bot_notifications():
+def tg_bot_summary(chat_id: str, limit: int = 5, if_none_match=()) -> tuple[dict, int]:
+    """
+    Профиль, unread_count и последние N уведомлений. Пользователь (с company через joined)
+    и max(id) его уведомлений — одним запросом; при совпадении версии с if_none_match —
+    ({"version": v}, 304) без выборки уведомлений.
+    """
+    chat_id = str(chat_id or "").strip()
+    if not chat_id:
+        return {"ok": False, "error": "EMPTY"}, 400
+    limit = max(1, min(safe_int(limit, 5), TG_BOT_SUMMARY_MAX))
+
+    last_id = (select(func.max(Notification.id))
+               .where(Notification.user_id == User.id)
+               .correlate(User)
+               .scalar_subquery())
+    row = db.session.query(User, last_id).filter(User.telegram_chat_id == chat_id).first()
+    if not row:
+        return {"ok": True, "linked": False, "items": []}, 200
+    u, max_id = row
+
+    user = user_to_dict(u)
+    raw = json.dumps([user, u.unread_count, max_id or 0, limit], sort_keys=True, default=str)
+    version = hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+    if version in if_none_match:
+        return {"version": version}, 304
+
+    return {"ok": True, "linked": True, "version": version, "user": user,
+            "unread_count": u.unread_count, "items": _tg_notification_items(u.id, limit)}, 200
+
+def _tg_bot_chat_and_limit(default_limit: int = 5) -> tuple[str, int]:
+    """chat_id/limit из query string или JSON-тела (бот исторически шлёт и GET, и POST)."""
     chat_id = (request.args.get("chat_id") or request.args.get("tg_chat_id") or "").strip()
-    limit = safe_int(request.args.get("limit") or 5, 5)
-
+    limit = safe_int(request.args.get("limit") or default_limit, default_limit)
     if not chat_id and request.is_json:
         j = request.get_json(silent=True) or {}
         chat_id = (str(j.get("chat_id") or j.get("tg_chat_id") or "")).strip()
         limit = safe_int(j.get("limit") or limit, limit)
+    return chat_id, limit
 
-    if not chat_id:
-        return jsonify(ok=False, error="EMPTY"), 400
-
-    u = User.query.filter_by(telegram_chat_id=chat_id).first()
-    if not u:
-        return jsonify(ok=True, linked=False, items=[])
-
-    rows = (Notification.query
-            .filter_by(user_id=u.id)
-            .order_by(Notification.created_at.desc())
-            .limit(limit)
-            .all())
+# Сервисный эндпоинт для бота: линк по коду
+@app.post("/api/telegram/bot/link")
+def api_tg_bot_link():
+    data = request.get_json(silent=True) or {}
+    payload, status = tg_bot_link(data.get("code"), data.get("chat_id"), (data.get("username") or "").strip())
+    return jsonify(payload), status
 
-    items = [{
-        "id": n.id,
-        "type": n.type,
-        "title": n.title,
-        "body": n.body,
-        "created_at": n.created_at.isoformat(),
-        "is_read": n.is_read,
-    } for n in rows]
+@app.route("/api/telegram/bot/me", methods=["GET", "POST"])
+def api_tg_bot_me():
+    chat_id, _ = _tg_bot_chat_and_limit()
+    payload, status = tg_bot_me(chat_id)
+    return jsonify(payload), status
 
-    return jsonify(ok=True, linked=True, user=user_to_dict(u), items=items)
+@app.route("/api/telegram/bot/notifications", methods=["GET", "POST"])
+def api_tg_bot_notifications():
+    chat_id, limit = _tg_bot_chat_and_limit()
+    payload, status = tg_bot_notifications(chat_id, limit)
+    return jsonify(payload), status
+
+@app.route("/api/telegram/bot/summary", methods=["GET", "POST"])
+def api_tg_bot_summary():
+    chat_id, limit = _tg_bot_chat_and_limit()
+    payload, status = tg_bot_summary(chat_id, limit, request.if_none_match)
+    if status == 304:
+        resp = make_response("", 304)
+        resp.set_etag(payload["version"])
+        return resp
+    resp = jsonify(payload)
+    if payload.get("version"):
+        resp.set_etag(payload["version"])
+    return resp, status
 
 # Avatar / Inventory
 # -----------------------------------------------------------------------------
@@ -2964,6 +3258,11 @@ def inject_helpers():
 def inject_telegram_vars():
     return dict(TELEGRAM_BOT_USERNAME=TELEGRAM_BOT_USERNAME)
 
+@app.context_processor
+def inject_notify_stream():
+    # SSE — только там, где воркер переживёт висящие соединения; иначе бейдж живёт опросом
+    return dict(NOTIFY_STREAM=notify_stream_capacity(request.environ) > 0)
+
 # --- SVG-аватар на лету ---
 def render_avatar_svg(gender: str = "any", display_name: str = "") -> str:
     male = (gender or "").lower() == "male"
@@ -4272,6 +4571,8 @@ def api_partner_company_task_create(company_id):
     )
 
     db.session.add(task); db.session.commit()
+    if task.due_at:
+        schedule_next_task_deadline()
     return as_json({"task_id": task.id})
 
 @app.post("/api/partners/company/<int:company_id>/tasks/<int:task_id>/assign")
@@ -4402,10 +4703,17 @@ def api_partner_task_update(company_id, task_id):
     for field in ("title","description","points_xp","coins","priority","require_proof","reward_achievement_id"):
         if field in data:
             setattr(t, field, data[field])
+    due_changed = False
     if "due_at" in data:
-        t.due_at = parse_iso_dt(data["due_at"])
+        new_due = parse_iso_dt(data["due_at"])
+        due_changed = new_due != t.due_at
+        t.due_at = new_due
+        if due_changed:
+            t.due_notified_at = None  # новый срок — новое напоминание
 
     db.session.commit()
+    if due_changed:
+        schedule_next_task_deadline()
     return as_json({"ok": True, "id": t.id})
 
 @app.post("/api/company/tasks/<int:task_id>/submit")
@@ -4565,7 +4873,11 @@ def api_notifications():
         q = q.filter_by(is_read=False)
 
     items = q.order_by(Notification.created_at.desc()).limit(50).all()
-    out = [{
+    out = [notification_to_dict(n) for n in items]
+    return as_json({"notifications": out})
+
+def notification_to_dict(n: Notification) -> Dict[str, Any]:
+    return {
         "id": n.id,
         "type": n.type,
         "title": n.title,
@@ -4573,21 +4885,130 @@ def api_notifications():
         "data": json.loads(n.data_json or "{}"),
         "is_read": n.is_read,
         "created_at": n.created_at.isoformat()
-    } for n in items]
-    return as_json({"notifications": out})
+    }
+
+NOTIFY_STREAM_HEARTBEAT_SEC = int(os.getenv("NOTIFY_STREAM_HEARTBEAT_SEC", "25"))
+NOTIFY_STREAM_RESYNC_SEC    = int(os.getenv("NOTIFY_STREAM_RESYNC_SEC", "60"))
+NOTIFY_STREAM_MAX_SEC       = int(os.getenv("NOTIFY_STREAM_MAX_SEC", "600"))
+
+@app.get("/api/notifications/stream")
+def api_notifications_stream():
+    """
+    SSE: держит соединение и отдаёт только новые уведомления (id > since / Last-Event-ID).
+    Между событиями соединение с БД не держим; просыпаемся по хабу, раз в HEARTBEAT шлём ping,
+    раз в RESYNC перечитываем БД (уведомления из других процессов). Через MAX_SEC закрываем —
+    EventSource переподключится сам с Last-Event-ID.
+    """
+    u = current_user()
+    p = current_partner()
+    if u:
+        key, fk = ("u", u.id), Notification.user_id
+    elif p:
+        key, fk = ("p", p.id), Notification.partner_id
+    else:
+        abort(401)
+
+    since = safe_int(request.headers.get("Last-Event-ID") or request.args.get("since"), 0)
+    if since <= 0:
+        # без курсора стартуем «с текущего момента», историю отдаёт /api/notifications
+        since = db.session.query(func.max(Notification.id)).filter(fk == key[1]).scalar() or 0
+    db.session.close()
+
+    if not notify_hub.enter(notify_stream_capacity(request.environ)):
+        return jsonify(ok=False, error="STREAM_UNAVAILABLE"), 503
+
+    def _fetch(after: int):
+        rows = (Notification.query.filter(fk == key[1], Notification.id > after)
+                .order_by(Notification.id.asc()).limit(50).all())
+        out = [notification_to_dict(n) for n in rows]
+        db.session.close()
+        return out
+
+    def gen():
+        last = since
+        started = last_sync = time.monotonic()
+        try:
+            yield "retry: 5000\n\n"
+            while time.monotonic() - started < NOTIFY_STREAM_MAX_SEC:
+                woke = notify_hub.wait(key, last, NOTIFY_STREAM_HEARTBEAT_SEC)
+                if woke or time.monotonic() - last_sync >= NOTIFY_STREAM_RESYNC_SEC:
+                    last_sync = time.monotonic()
+                    items = _fetch(last)
+                    for it in items:
+                        last = it["id"]
+                        yield f"id: {last}\nevent: notification\ndata: {json.dumps(it, ensure_ascii=False)}\n\n"
+                    if items:
+                        continue
+                    if woke:
+                        # хаб опередил выборку (строка удалена/не видна) — иначе wait() вернётся сразу
+                        # и поток уйдёт в холостой цикл с запросом к БД на каждой итерации
+                        last = max(last, notify_hub.latest(key))
+                yield ": ping\n\n"
+        finally:
+            notify_hub.leave()
+
+    resp = Response(stream_with_context(gen()), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+NOTIFICATIONS_MARK_MAX_IDS = 500
 
 @app.post("/api/notifications/read")
 def api_notifications_mark_read():
+    """
+    Отмечает прочитанными то, что клиент реально показал:
+      {"up_to_id": N}  — все непрочитанные с id <= N;
+      {"ids": [...]}   — конкретные уведомления (до NOTIFICATIONS_MARK_MAX_IDS);
+      без параметров   — все непрочитанные (старое поведение).
+    unread_count уменьшается ровно на число отмеченных строк.
+    """
     u = current_user()
     p = current_partner()
     if u:
-        Notification.query.filter_by(user_id=u.id, is_read=False).update({"is_read": True})
+        rcpt, q = u, Notification.query.filter_by(user_id=u.id, is_read=False)
     elif p:
-        Notification.query.filter_by(partner_id=p.id, is_read=False).update({"is_read": True})
+        rcpt, q = p, Notification.query.filter_by(partner_id=p.id, is_read=False)
     else:
         abort(401)
+
+    data = request.get_json(silent=True) or {}
+    raw_ids = data.get("ids")
+    up_to_id = safe_int(data.get("up_to_id") or request.args.get("up_to_id"), 0)
+    if isinstance(raw_ids, list):
+        ids = {i for i in (safe_int(x, 0) for x in raw_ids[:NOTIFICATIONS_MARK_MAX_IDS]) if i > 0}
+        if not ids:
+            return as_json({"ok": True, "marked": 0})
+        q = q.filter(Notification.id.in_(ids))
+    elif up_to_id > 0:
+        q = q.filter(Notification.id <= up_to_id)
+
+    marked = q.update({"is_read": True}, synchronize_session=False)
+    if marked:
+        model = type(rcpt)
+        rcpt.unread_count = case((model.unread_count > marked, model.unread_count - marked), else_=0)
     db.session.commit()
-    return as_json({"ok": True})
+    return as_json({"ok": True, "marked": marked})
+
+@app.get("/api/notifications/unread_count")
+def api_notifications_unread_count():
+    """
+    Бейдж непрочитанных: одна выборка по PK + ETag.
+    Браузер ревалидирует сам (Cache-Control: no-cache) и при If-None-Match получает 304.
+    """
+    if session.get("uid"):
+        kind, model, rid = "u", User, session["uid"]
+    elif session.get("partner_uid"):
+        kind, model, rid = "p", PartnerUser, session["partner_uid"]
+    else:
+        abort(401)
+    n = db.session.execute(select(model.unread_count).where(model.id == rid)).scalar()
+    if n is None:
+        abort(401)
+    resp = jsonify(unread=int(n))
+    resp.set_etag(f"{kind}{rid}-{n}")
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp.make_conditional(request)
 
 @app.get("/training/create")
 @login_required_page
@@ -5020,6 +5441,8 @@ def admin_company_task(company_id):
         due_at=due_at, is_active=True, created_by_user_id=None, created_by_partner_id=None
     )
     db.session.add(task); db.session.commit()
+    if task.due_at:
+        schedule_next_task_deadline()
     return as_json({"task_id": task.id})
 
 @app.post("/api/admin/companies/<int:company_id>/assign_course")
@@ -5584,27 +6007,38 @@ def api_partner_request_reject(req_id):
 
 # ========================= Partner API: Task Reports (moderation) ===================
 
-def _latest_by_assign(rows):
+def _latest_by_assign():
     """
-    rows: list of (assign, task, user, submission | None)
-    возвращает dict[assign_id] = {"a":assign,"t":task,"u":user,"s":latest_submission_or_None}
+    Коррелированный подзапрос: id самого свежего сабмита для CompanyTaskAssign
+    (по submitted_at, затем по id). Считается только для строк текущей страницы.
     """
-    bucket = {}
-    for a, t, u, s in rows:
-        rec = bucket.get(a.id)
-        if not rec:
-            bucket[a.id] = {"a": a, "t": t, "u": u, "s": s}
-        else:
-            # выбираем самый свежий сабмит
-            if s and (not rec["s"] or (s.submitted_at or now_utc()) > (rec["s"].submitted_at or now_utc())):
-                rec["s"] = s
+    return (select(CompanyTaskSubmission.id)
+            .where(CompanyTaskSubmission.assign_id == CompanyTaskAssign.id)
+            .order_by(CompanyTaskSubmission.submitted_at.desc(), CompanyTaskSubmission.id.desc())
+            .limit(1)
+            .correlate(CompanyTaskAssign)
+            .scalar_subquery())
+
+def _encode_reports_cursor(submitted_at: Optional[datetime], assign_id: int) -> str:
+    raw = f"{submitted_at.isoformat() if submitted_at else ''}|{assign_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def _decode_reports_cursor(s: str):
+    """-> (submitted_at | None, assign_id) или None, если курсор битый."""
+    try:
+        raw = base64.urlsafe_b64decode(s + "=" * (-len(s) % 4)).decode()
+        ts, aid = raw.rsplit("|", 1)
+        return (datetime.fromisoformat(ts) if ts else None), int(aid)
+    except Exception:
+        return None
 
-    return bucket
+TASK_REPORTS_PAGE = 50
+TASK_REPORTS_PAGE_MAX = 200
 
 @app.get("/api/partners/task_reports")
 def api_partner_task_reports():
     """
-    Сводка назначений задач для компании.
+    Очередь отчётов по задачам компании (keyset-пагинация).
     Доступ: партнёр-владелец ИЛИ admin/manager компании.
 
     query:
@@ -5613,6 +6047,11 @@ def api_partner_task_reports():
           * для пользователя: его company_id.
       - status = assigned|submitted|approved|rejected|pending|all
         (alias: pending -> submitted)
+      - limit (по умолчанию 50, максимум 200)
+      - cursor — next_cursor из предыдущего ответа
+
+    Ответ: reports (+ последний сабмит: image_url, comment), next_cursor,
+    counts по всем статусам (только на первой странице — для табов).
     """
     # --- Кто обращается
     p = current_partner()
@@ -5655,35 +6094,106 @@ def api_partner_task_reports():
     if status not in allowed_status:
         status = "submitted"
 
-    # --- Выборка
-    q = (db.session.query(CompanyTaskAssign, CompanyTask, User)
+    limit = min(max(safe_int(request.args.get("limit"), TASK_REPORTS_PAGE), 1), TASK_REPORTS_PAGE_MAX)
+    cursor = None
+    if request.args.get("cursor"):
+        cursor = _decode_reports_cursor(request.args["cursor"])
+        if cursor is None:
+            abort(400, description="bad cursor")
+
+    # --- Выборка: только нужные колонки (без joined-eager связей моделей)
+    q = (db.session.query(
+            CompanyTaskAssign.id, CompanyTaskAssign.status,
+            CompanyTaskAssign.submitted_at, CompanyTaskAssign.completed_at,
+            CompanyTask.id.label("task_id"), CompanyTask.title.label("task_title"),
+            User.id.label("user_id"), User.display_name.label("user_name"),
+            CompanyTaskSubmission.image_url, CompanyTaskSubmission.comment)
          .join(CompanyTask, CompanyTaskAssign.task_id == CompanyTask.id)
          .join(User, User.id == CompanyTaskAssign.user_id)
+         .outerjoin(CompanyTaskSubmission, CompanyTaskSubmission.id == _latest_by_assign())
          .filter(CompanyTask.company_id == company_id))
 
     if status != "all":
         q = q.filter(CompanyTaskAssign.status == status)
 
-    # SQLite терпит NULLS LAST не везде — делаем безопасный порядок
-    q = q.order_by(
-        CompanyTaskAssign.submitted_at.desc(),
-        CompanyTaskAssign.completed_at.desc(),
-        CompanyTaskAssign.id.desc()
-    )
+    # keyset по (submitted_at DESC, id DESC); в SQLite NULL при DESC идут последними
+    if cursor:
+        cur_ts, cur_id = cursor
+        if cur_ts is not None:
+            q = q.filter(or_(
+                CompanyTaskAssign.submitted_at < cur_ts,
+                and_(CompanyTaskAssign.submitted_at == cur_ts, CompanyTaskAssign.id < cur_id),
+                CompanyTaskAssign.submitted_at.is_(None),
+            ))
+        else:
+            q = q.filter(CompanyTaskAssign.submitted_at.is_(None), CompanyTaskAssign.id < cur_id)
+
+    q = q.order_by(CompanyTaskAssign.submitted_at.desc(), CompanyTaskAssign.id.desc())
+
+    rows = q.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
 
-    rows = q.limit(300).all()
     out = []
-    for a, t, usr in rows:
+    for r in rows:
         out.append({
-            "task_id": t.id,
-            "task_title": t.title,
-            "user_id": usr.id,
-            "user_name": usr.display_name,
-            "status": a.status,
-            "submitted_at": a.submitted_at.isoformat() if a.submitted_at else None,
-            "completed_at": a.completed_at.isoformat() if a.completed_at else None
+            "id": r.id,
+            "assign_id": r.id,
+            "task_id": r.task_id,
+            "task_title": r.task_title,
+            "user_id": r.user_id,
+            "user_name": r.user_name,
+            "status": r.status,
+            "submitted_at": r.submitted_at.isoformat() if r.submitted_at else None,
+            "completed_at": r.completed_at.isoformat() if r.completed_at else None,
+            "image_url": r.image_url,
+            "comment": r.comment or "",
+            "attachments": [{"url": r.image_url}] if r.image_url else [],
         })
-    return as_json({"reports": out})
+
+    payload = {
+        "reports": out,
+        "next_cursor": _encode_reports_cursor(rows[-1].submitted_at, rows[-1].id) if has_more else None,
+    }
+
+    # --- Счётчики для всех табов одним GROUP BY (только на первой странице)
+    if cursor is None:
+        counts = {k: 0 for k in ("assigned", "submitted", "approved", "rejected")}
+        for st, cnt in (db.session.query(CompanyTaskAssign.status, func.count(CompanyTaskAssign.id))
+                        .join(CompanyTask, CompanyTaskAssign.task_id == CompanyTask.id)
+                        .filter(CompanyTask.company_id == company_id)
+                        .group_by(CompanyTaskAssign.status)
+                        .all()):
+            counts[st] = int(cnt)
+        counts["pending"] = counts["submitted"]
+        counts["all"] = sum(v for k, v in counts.items() if k != "pending")
+        payload["counts"] = counts
+
+    return as_json(payload)
+
+def _check_partner_owns_assign(p: "PartnerUser", assign_id: int):
+    """-> (assign, task, user); 404, если назначения нет, 403 — если компания не партнёра."""
+    a = db.session.get(CompanyTaskAssign, assign_id)
+    if not a or not a.task or not a.user:
+        abort(404, description="Assign not found")
+    c = db.session.get(Company, a.task.company_id)
+    if not c or c.owner_partner_id != p.id:
+        abort(403)
+    return a, a.task, a.user
+
+def _task_approved_note(score, comment: str) -> str:
+    note = "Задача зачтена"
+    if isinstance(score, int):
+        note += f" (оценка: {score}%)"
+    if comment:
+        note += f". Комментарий: {comment}"
+    return note
+
+def _task_rejected_note(reason: str) -> str:
+    body = "Отчёт по задаче отклонён."
+    if reason:
+        body += f" Причина: {reason}"
+    return body
 
 @app.post("/api/partners/task_reports/<int:assign_id>/approve")
 @partner_required
@@ -5714,14 +6224,9 @@ def api_partner_task_report_approve(assign_id):
         db.session.add(UserAchievement(user_id=u.id, achievement_id=t.reward_achievement_id))
 
     # уведомление
-    note = "Задача зачтена"
-    if isinstance(score, int):
-        note += f" (оценка: {score}%)"
-    if mod_comment:
-        note += f". Комментарий: {mod_comment}"
     db.session.add(Notification(
         user_id=u.id, type="task_result",
-        title="Задача зачтена", body=note,
+        title="Задача зачтена", body=_task_approved_note(score, mod_comment),
         data_json=json.dumps({"task_id": t.id, "score": score, "comment": mod_comment})
     ))
 
@@ -5744,21 +6249,347 @@ def api_partner_task_report_reject(assign_id):
     a.status = "rejected"
     a.completed_at = now_utc()
 
-    body = "Отчёт по задаче отклонён."
-    if reason:
-        body += f" Причина: {reason}"
     db.session.add(Notification(
         user_id=u.id, type="task_result",
-        title="Задача отклонена", body=body,
+        title="Задача отклонена", body=_task_rejected_note(reason),
         data_json=json.dumps({"task_id": t.id, "reason": reason})
     ))
 
     db.session.commit()
     return as_json({"ok": True, "status": a.status})
 
+TASK_REPORTS_BULK_MAX = 500
+
+@app.post("/api/partners/task_reports/bulk")
+@partner_required
+def api_partner_task_reports_bulk():
+    """
+    Массовая модерация отчётов.
+    body: { "items": [ {"assign_id": int, "decision": "approve"|"reject",
+                        "score"?: int, "comment"?: str, "reason"?: str}, ... ] }
+
+    Владение проверяется одним запросом, награды агрегируются по пользователю,
+    ScoreEvent / UserAchievement / Notification пишутся пачками, коммит — один.
+    Ответ: results[] по каждому assign_id (status | error); некорректные элементы — error BAD_ITEM
+    с index. Решение применяется только к ещё не рассмотренным отчётам: если статус успели
+    сменить параллельно, элемент попадает в results как SKIPPED.
+    """
+    p = current_partner()
+    require_json()
+    items = (request.get_json() or {}).get("items") or []
+    if not isinstance(items, list) or not items:
+        abort(400, description="items required")
+    if len(items) > TASK_REPORTS_BULK_MAX:
+        abort(400, description=f"too many items (max {TASK_REPORTS_BULK_MAX})")
+
+    # последнее решение по assign_id побеждает
+    decisions: Dict[int, dict] = {}
+    results = []
+    for i, it in enumerate(items):
+        if not isinstance(it, dict):
+            results.append({"index": i, "ok": False, "error": "BAD_ITEM"})
+            continue
+        aid = safe_int(it.get("assign_id"), 0)
+        decision = it.get("decision")
+        decision = decision.strip().lower() if isinstance(decision, str) else ""
+        score = it.get("score")
+        bad = (aid <= 0 or decision not in ("approve", "reject")
+               or any(it.get(k) is not None and not isinstance(it.get(k), str) for k in ("comment", "reason"))
+               or (score is not None and (isinstance(score, bool) or not isinstance(score, int))))
+        if bad:
+            results.append({"index": i, "assign_id": aid or None, "ok": False, "error": "BAD_ITEM"})
+            continue
+        decisions[aid] = it | {"decision": decision}
+    if not decisions:
+        return as_json({"ok": False, "error": "no valid items", "results": results}), 400
+
+    # --- владение + данные задачи одним запросом
+    rows = (db.session.query(
+                CompanyTaskAssign.id, CompanyTaskAssign.status, CompanyTaskAssign.user_id,
+                CompanyTask.id.label("task_id"), CompanyTask.title, CompanyTask.points_xp,
+                CompanyTask.coins, CompanyTask.require_proof, CompanyTask.reward_achievement_id)
+            .join(CompanyTask, CompanyTaskAssign.task_id == CompanyTask.id)
+            .join(Company, Company.id == CompanyTask.company_id)
+            .filter(CompanyTaskAssign.id.in_(list(decisions)),
+                    Company.owner_partner_id == p.id)
+            .all())
+    found = {r.id: r for r in rows}
+
+    approve_rows, reject_rows = [], []
+    for aid, it in decisions.items():
+        r = found.get(aid)
+        if not r:
+            results.append({"assign_id": aid, "ok": False, "error": "NOT_FOUND"})
+            continue
+        target = "approved" if it["decision"] == "approve" else "rejected"
+        if r.status == target:
+            results.append({"assign_id": aid, "ok": True, "already": True, "status": target})
+            continue
+        reviewable = ("submitted",) if r.require_proof else ("assigned", "submitted")
+        if r.status not in reviewable:
+            results.append({"assign_id": aid, "ok": False, "error": "BAD_STATUS", "status": r.status})
+            continue
+        (approve_rows if target == "approved" else reject_rows).append((r, it))
+
+    # UPDATE только по нерассмотренным: уже одобренные/отклонённые (в т.ч. параллельно) не трогаем,
+    # иначе награды и уведомления ушли бы повторно
+    now = now_utc()
+    updated: set = set()
+    for target, batch in (("approved", approve_rows), ("rejected", reject_rows)):
+        if batch:
+            updated |= set(db.session.execute(
+                update(CompanyTaskAssign)
+                .where(CompanyTaskAssign.id.in_([r.id for r, _ in batch]),
+                       or_(CompanyTaskAssign.status == "submitted",
+                           and_(CompanyTaskAssign.status == "assigned",
+                                CompanyTaskAssign.id.in_([r.id for r, _ in batch if not r.require_proof]))))
+                .values(status=target, completed_at=now)
+                .returning(CompanyTaskAssign.id)
+                .execution_options(synchronize_session=False)
+            ).scalars())
+    for target, batch in (("approved", approve_rows), ("rejected", reject_rows)):
+        for r, _ in batch:
+            if r.id in updated:
+                results.append({"assign_id": r.id, "ok": True, "status": target})
+            else:
+                results.append({"assign_id": r.id, "ok": False, "error": "SKIPPED", "status": "changed"})
+    approve_rows = [(r, it) for r, it in approve_rows if r.id in updated]
+    reject_rows = [(r, it) for r, it in reject_rows if r.id in updated]
+
+    # --- награды: суммарный прирост на пользователя
+    xp_by_user: Dict[int, int] = {}
+    coins_by_user: Dict[int, int] = {}
+    for r, _ in approve_rows:
+        xp_by_user[r.user_id] = xp_by_user.get(r.user_id, 0) + max(0, r.points_xp)
+        coins_by_user[r.user_id] = coins_by_user.get(r.user_id, 0) + max(0, r.coins)
+    if xp_by_user:
+        for usr in User.query.filter(User.id.in_(list(xp_by_user))).all():
+            usr.add_xp(xp_by_user[usr.id])
+            usr.add_coins(coins_by_user[usr.id])
+
+    # --- ачивки: существующие пары одним запросом, дубли внутри пачки отсекаем
+    wanted = {(r.user_id, r.reward_achievement_id) for r, _ in approve_rows if r.reward_achievement_id}
+    if wanted:
+        have = set(db.session.query(UserAchievement.user_id, UserAchievement.achievement_id)
+                   .filter(UserAchievement.user_id.in_({uid for uid, _ in wanted}),
+                           UserAchievement.achievement_id.in_({ach for _, ach in wanted}))
+                   .all())
+        db.session.add_all([UserAchievement(user_id=uid, achievement_id=ach)
+                            for uid, ach in wanted - have])
+
+    # --- события и уведомления: SQLAlchemy 2.x сбрасывает их multi-row INSERT'ами
+    db.session.add_all([ScoreEvent(
+        user_id=r.user_id, source="task", points=max(0, r.points_xp), coins=max(0, r.coins),
+        meta_json=json.dumps({"task_id": r.task_id, "title": r.title})
+    ) for r, _ in approve_rows])
+
+    notes = []
+    for r, it in approve_rows:
+        score = it.get("score")
+        comment = (it.get("comment") or "").strip()
+        notes.append(Notification(
+            user_id=r.user_id, type="task_result",
+            title="Задача зачтена", body=_task_approved_note(score, comment),
+            data_json=json.dumps({"task_id": r.task_id, "score": score, "comment": comment})
+        ))
+    for r, it in reject_rows:
+        reason = (it.get("reason") or it.get("comment") or "").strip()
+        notes.append(Notification(
+            user_id=r.user_id, type="task_result",
+            title="Задача отклонена", body=_task_rejected_note(reason),
+            data_json=json.dumps({"task_id": r.task_id, "reason": reason})
+        ))
+    db.session.add_all(notes)
+
+    db.session.commit()
+    return as_json({
+        "ok": True,
+        "approved": len(approve_rows),
+        "rejected": len(reject_rows),
+        "results": results,
+    })
+
+
+# -----------------------------------------------------------------------------
+# Background jobs: task deadlines
+# -----------------------------------------------------------------------------
+# Точность даёт ОДНА date-задача на ближайший due_at (индекс ix_company_tasks_due_pending),
+# переназначаемая после срабатывания. Задачи, созданные в веб-воркерах (там планировщик не
+# запущен), подхватывает редкий пересмотр по тому же индексу — он же заново взводит date-задачу.
+TASK_DEADLINE_JOB_ID = "task_deadlines"
+TASK_DEADLINE_RESCAN_MIN = int(os.getenv("TASK_DEADLINE_RESCAN_MIN", "1"))
+
+def _pending_deadlines_q():
+    return (db.session.query(CompanyTask.id, CompanyTask.title, CompanyTask.due_at)
+            .filter(CompanyTask.due_notified_at.is_(None),
+                    CompanyTask.due_at.isnot(None),
+                    CompanyTask.is_active.is_(True)))
+
+def schedule_next_task_deadline():
+    """Переназначает date-задачу планировщика на ближайший неотработанный дедлайн (вне процесса джобов — no-op)."""
+    if not scheduler.running:
+        return
+    with app.app_context():
+        nxt = _pending_deadlines_q().with_entities(func.min(CompanyTask.due_at)).scalar()
+    if nxt is None:
+        if scheduler.get_job(TASK_DEADLINE_JOB_ID):
+            scheduler.remove_job(TASK_DEADLINE_JOB_ID)
+        return
+    if nxt.tzinfo is not None:
+        nxt = nxt.replace(tzinfo=None)
+    scheduler.add_job(
+        fire_task_deadlines, "date",
+        run_date=max(nxt, now_utc()),
+        id=TASK_DEADLINE_JOB_ID, replace_existing=True,
+        misfire_grace_time=None, coalesce=True,
+    )
+
+def fire_task_deadlines():
+    """
+    Срабатывает на дедлайне и по пересмотру: забирает наступившие задачи одним условным
+    UPDATE … WHERE due_notified_at IS NULL RETURNING — второй планировщик (или пересекшийся
+    запуск) получит пустой список, и task_due не задвоится. Назначенным в статусе assigned —
+    task_due одним батчем; привязанным к Telegram доставка ставится в outbox хуком Notification
+    (TELEGRAM_NOTIFY_TYPES ограничивает типы). В конце планирует следующий запуск.
+    """
+    with app.app_context():
+        now = now_utc()
+        claimed = db.session.execute(
+            update(CompanyTask)
+            .where(CompanyTask.due_notified_at.is_(None),
+                   CompanyTask.due_at.isnot(None),
+                   CompanyTask.due_at <= now,
+                   CompanyTask.is_active.is_(True))
+            .values(due_notified_at=now)
+            .returning(CompanyTask.id, CompanyTask.title)
+            .execution_options(synchronize_session=False)
+        ).all()
+        if claimed:
+            titles = {tid: title for tid, title in claimed}
+            rows = (db.session.query(CompanyTaskAssign.task_id, CompanyTaskAssign.user_id)
+                    .filter(CompanyTaskAssign.task_id.in_(list(titles)),
+                            CompanyTaskAssign.status == "assigned")
+                    .all())
+            db.session.add_all([Notification(
+                user_id=uid, type="task_due",
+                title="Срок задачи наступил", body=f"{titles[tid]} — можно отправить отчёт",
+                data_json=json.dumps({"task_id": tid})
+            ) for tid, uid in rows])
+            db.session.commit()
+            app.logger.info("task_due: %s tasks, %s notifications", len(titles), len(rows))
+    schedule_next_task_deadline()
+
+# -----------------------------------------------------------------------------
+# Background jobs: unread counters
+# -----------------------------------------------------------------------------
+UNREAD_RECONCILE_MINUTES = int(os.getenv("UNREAD_RECONCILE_MINUTES", "60"))
+
+def reconcile_unread_counts():
+    """Сверяет users/partner_users.unread_count с фактическим числом непрочитанных (чинит дрейф)."""
+    with app.app_context():
+        fixed = 0
+        for model, fk in ((User, Notification.user_id), (PartnerUser, Notification.partner_id)):
+            actual = (select(func.count(Notification.id))
+                      .where(fk == model.id, Notification.is_read.is_(False))
+                      .correlate(model)
+                      .scalar_subquery())
+            res = db.session.execute(
+                update(model).where(model.unread_count != actual).values(unread_count=actual)
+                .execution_options(synchronize_session=False)
+            )
+            fixed += res.rowcount or 0
+        db.session.commit()
+        if fixed:
+            app.logger.warning("unread_count reconciled for %s recipients", fixed)
+
+# -----------------------------------------------------------------------------
+# Background jobs: notification retention
+# -----------------------------------------------------------------------------
+NOTIF_RETENTION_DAYS  = int(os.getenv("NOTIF_RETENTION_DAYS", "90"))
+NOTIF_RETENTION_CHUNK = int(os.getenv("NOTIF_RETENTION_CHUNK", "1000"))
+
+def compact_notifications():
+    """
+    Удаляет прочитанные уведомления старше NOTIF_RETENTION_DAYS порциями по CHUNK,
+    складывая их количество в помесячный notifications_archive. Каждая порция —
+    своя короткая транзакция, чтобы не держать блокировку на всю таблицу. Порция забирается
+    DELETE … RETURNING: в архив идут только строки, удалённые именно этим запуском, и
+    параллельный запуск не посчитает их второй раз.
+    """
+    if NOTIF_RETENTION_DAYS <= 0:
+        return
+    with app.app_context():
+        cutoff = now_utc() - timedelta(days=NOTIF_RETENTION_DAYS)
+        total = 0
+        while True:
+            chunk = (select(Notification.id)
+                     .where(Notification.is_read.is_(True), Notification.created_at < cutoff)
+                     .order_by(Notification.id.asc())
+                     .limit(NOTIF_RETENTION_CHUNK)
+                     .scalar_subquery())
+            rows = db.session.execute(
+                delete(Notification)
+                .where(Notification.id.in_(chunk), Notification.is_read.is_(True))
+                .returning(Notification.user_id, Notification.partner_id,
+                           Notification.type, Notification.created_at)
+                .execution_options(synchronize_session=False)
+            ).all()
+            if not rows:
+                db.session.commit()
+                break
+
+            agg: Dict[tuple, int] = {}
+            for uid, pid, typ, created in rows:
+                k = (created.strftime("%Y-%m"), uid, pid, typ or "system")
+                agg[k] = agg.get(k, 0) + 1
+
+            for (month, uid, pid, typ), cnt in agg.items():
+                arc = NotificationArchive.query.filter(
+                    NotificationArchive.month == month,
+                    NotificationArchive.user_id.is_(uid) if uid is None else NotificationArchive.user_id == uid,
+                    NotificationArchive.partner_id.is_(pid) if pid is None else NotificationArchive.partner_id == pid,
+                    NotificationArchive.type == typ,
+                ).first()
+                if arc:
+                    arc.count = NotificationArchive.count + cnt
+                else:
+                    db.session.add(NotificationArchive(month=month, user_id=uid, partner_id=pid, type=typ, count=cnt))
+            db.session.commit()
+            total += len(rows)
+            if len(rows) < NOTIF_RETENTION_CHUNK:
+                break
+        if total:
+            app.logger.info("notifications compacted: %s rows archived", total)
+
+def start_background_jobs():
+    if scheduler.running:
+        return
+    scheduler.start()
+    schedule_next_task_deadline()
+    scheduler.add_job(fire_task_deadlines, "interval", minutes=TASK_DEADLINE_RESCAN_MIN,
+                      id="task_deadlines_rescan", replace_existing=True, coalesce=True, max_instances=1)
+    scheduler.add_job(reconcile_unread_counts, "interval", minutes=UNREAD_RECONCILE_MINUTES,
+                      id="unread_reconcile", replace_existing=True, coalesce=True)
+    scheduler.add_job(compact_notifications, "cron", hour=3, minute=30,
+                      id="notif_retention", replace_existing=True, coalesce=True)
+    amocrm_integration.start_sync_jobs(app)
+    tg_outbox.start()
+
+# Под WSGI (gunicorn и т.п.) фоновые задачи включаются явно: BACKGROUND_JOBS=1
+if os.getenv("BACKGROUND_JOBS") == "1":
+    start_background_jobs()
+
+# Доставку держит один процесс — тот, где BACKGROUND_JOBS=1 (start_background_jobs). В веб-процессе
+# воркеры outbox — только при TG_OUTBOX_IN_PROCESS=1 (однопроцессный запуск), и не в родителе
+# debug-релоадера — там запросы не обслуживаются
+if telegram_outbox.TG_OUTBOX_IN_PROCESS and (__name__ != "__main__" or os.environ.get("WERKZEUG_RUN_MAIN") == "true"):
+    tg_outbox.start()
 
 # -----------------------------------------------------------------------------
 # Run
 # -----------------------------------------------------------------------------
 if __name__ == "__main__":
+    # debug=True запускает релоадер: планировщик поднимаем только в рабочем процессе
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background_jobs()
     app.run(host="0.0.0.0", port=int(os.getenv("PORT", "5000")), debug=True)
@@ -0,0 +1,89 @@
+# bot_control.py
+"""
+Лёгкий канал «бэкенд → бот»: сообщает боту, что данные чата изменились
+(привязка/сброс, новое уведомление), чтобы бот сбросил кэш и не опрашивал бэкенд на каждое сообщение.
+
+Бот поднимает маленький HTTP-сервер (BOT_CONTROL_PORT в bot.py), сюда задаётся его адрес:
+  BOT_CONTROL_URL="http://127.0.0.1:8081"   (пусто — канал выключен, бот живёт на TTL;
+                                            несколько вебхук-воркеров — через запятую)
+  BOT_CONTROL_SECRET="..."                  (заголовок X-Bot-Control-Secret; обязателен —
+                                            без него бот не поднимает сервер, канал выключен)
+
+Отправка не блокирует запрос: POST уходит из отдельного потока, ошибки только логируются —
+в худшем случае бот увидит изменения по истечении TTL.
+
+push() — синхронная передача пачки сообщений боту для доставки (TELEGRAM_DELIVERY=bot
+в telegram_outbox.py); вызывается из потока-диспетчера outbox, не из веб-запроса.
+"""
+from __future__ import annotations
+
+import itertools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable
+
+import httpx
+
+BOT_CONTROL_URLS   = [u.strip().rstrip("/") for u in (os.getenv("BOT_CONTROL_URL") or "").split(",") if u.strip()]
+BOT_CONTROL_SECRET = os.getenv("BOT_CONTROL_SECRET", "")
+BOT_CONTROL_TIMEOUT_SEC = float(os.getenv("BOT_CONTROL_TIMEOUT_SEC", "2"))
+BOT_PUSH_TIMEOUT_SEC    = float(os.getenv("BOT_PUSH_TIMEOUT_SEC", "30"))
+
+ENABLED = bool(BOT_CONTROL_URLS) and bool(BOT_CONTROL_SECRET)
+
+log = logging.getLogger("bot_control")
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bot-control")
+_client: httpx.Client | None = None
+_rr = itertools.count()
+
+
+def _http() -> httpx.Client:
+    global _client
+    if _client is None:
+        _client = httpx.Client(
+            timeout=BOT_CONTROL_TIMEOUT_SEC,
+            headers={"X-Bot-Control-Secret": BOT_CONTROL_SECRET},
+        )
+    return _client
+
+
+def _post(path: str, payload: dict) -> None:
+    for base in BOT_CONTROL_URLS:
+        try:
+            r = _http().post(base + path, json=payload)
+            if r.status_code >= 400:
+                log.warning("bot control %s%s -> HTTP %s", base, path, r.status_code)
+        except Exception as e:
+            log.warning("bot control %s%s failed: %r", base, path, e)
+
+
+def invalidate(chat_ids: Iterable) -> None:
+    """Сбросить кэш бота для указанных чатов (fire-and-forget)."""
+    if not ENABLED:
+        return
+    ids = sorted({str(c) for c in chat_ids if c})
+    if ids:
+        _executor.submit(_post, "/control/invalidate", {"chat_ids": ids})
+
+
+def push(messages: list[dict]) -> list[dict] | None:
+    """
+    Передаёт пачку [{id, chat_id, text, parse_mode}] одному из воркеров бота (round-robin,
+    при сетевой ошибке — следующему). Возвращает [{id, status: sent|retry|failed, retry_after?, error?}]
+    или None, если ни один воркер не ответил.
+    """
+    if not ENABLED or not messages:
+        return None
+    start = next(_rr)
+    for i in range(len(BOT_CONTROL_URLS)):
+        base = BOT_CONTROL_URLS[(start + i) % len(BOT_CONTROL_URLS)]
+        try:
+            r = _http().post(base + "/control/push", json={"messages": messages}, timeout=BOT_PUSH_TIMEOUT_SEC)
+            if r.status_code == 200:
+                return (r.json() or {}).get("results") or []
+            log.warning("bot push %s -> HTTP %s", base, r.status_code)
+        except Exception as e:
+            log.warning("bot push %s failed: %r", base, e)
+    return None
@@ -0,0 +1,302 @@
+# bot_loadtest.py
+"""
+Нагрузочный прогон bot.py без настоящего Telegram.
+
+Поднимает в одном процессе:
+  - заглушку Bot API (getMe / getUpdates / sendMessage / deleteWebhook …) — бот ходит в неё
+    через TELEGRAM_API_BASE;
+  - заглушку бэкенда (/api/telegram/bot/summary, /api/telegram/bot/link) или использует
+    настоящий Flask (--backend http://localhost:5000). Настоящий бэкенд принимает только
+    выданные коды привязки: их нужно передать файлом (--codes, по коду на строку) или выпустить
+    через приложение (--seed-codes: коды получат первые --chats непривязанных пользователей БД,
+    после прогона они окажутся привязаны к фиктивным чатам — только на тестовой базе);
+  - сам бот (bot.main() в режиме polling).
+
+Каждый из --chats чатов ведёт себя как пользователь: /start → код привязки → «👤 Профиль» →
+N раз «🔔 Уведомления», дожидаясь ответа бота и делая паузу --think между шагами.
+
+Итог: перцентили задержки «апдейт → ответ бота», вызовы бэкенда на апдейт (по эндпоинтам,
+из метрик BackendClient) и пропускная способность по исходящим сообщениям.
+
+Если привязка хотя бы одного чата не удалась, прогон прерывается с кодом 1 — иначе
+замерялась бы только ветка «не привязан».
+
+Пример:
+  python bot_loadtest.py --chats 2000 --presses 3 --ramp 10 --think 0.5
+  python bot_loadtest.py --backend http://localhost:5000 --seed-codes --chats 200
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+from aiohttp import web
+
+FAKE_TOKEN = "123456:LOADTEST"
+
+
+# ======== Fake Telegram Bot API ========
+class FakeTelegram:
+    def __init__(self):
+        self._updates: list[dict] = []
+        self._has_updates = asyncio.Event()
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._waiters: dict[int, asyncio.Future] = {}
+        self.sent = 0
+
+    def inject(self, chat_id: int, text: str) -> asyncio.Future:
+        """Кладёт апдейт в очередь getUpdates; future завершится (время, текст) первого ответа бота в этот чат."""
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id] = fut
+        self._updates.append({
+            "update_id": self._next_update_id,
+            "message": {
+                "message_id": self._next_message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "Load", "username": f"u{chat_id}"},
+                "text": text,
+            },
+        })
+        self._next_update_id += 1
+        self._next_message_id += 1
+        self._has_updates.set()
+        return fut
+
+    async def _params(self, request: web.Request) -> dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        return dict(await request.post()) or dict(request.query)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        p = await self._params(request)
+
+        if method == "getMe":
+            return self._ok({"id": 1, "is_bot": True, "first_name": "Load", "username": "load_bot"})
+
+        if method == "getUpdates":
+            offset = int(p.get("offset") or 0)
+            if offset:
+                self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            if not self._updates:
+                self._has_updates.clear()
+                try:
+                    await asyncio.wait_for(self._has_updates.wait(), timeout=float(p.get("timeout") or 1))
+                except asyncio.TimeoutError:
+                    pass
+            batch = self._updates[:100]
+            return self._ok(batch)
+
+        if method == "sendMessage":
+            chat_id = int(p.get("chat_id"))
+            self.sent += 1
+            fut = self._waiters.pop(chat_id, None)
+            if fut and not fut.done():
+                fut.set_result((time.perf_counter(), p.get("text") or ""))
+            msg_id = self._next_message_id
+            self._next_message_id += 1
+            return self._ok({"message_id": msg_id, "date": int(time.time()),
+                             "chat": {"id": chat_id, "type": "private"}, "text": p.get("text") or ""})
+
+        # deleteWebhook, setWebhook, setMyCommands и прочее — просто «ок»
+        return self._ok(True)
+
+    @staticmethod
+    def _ok(result) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        return app
+
+
+# ======== Fake backend ========
+class FakeBackend:
+    """Минимальная имитация бот-эндпоинтов Flask: привязка по любому коду, сводка с версией."""
+
+    def __init__(self, latency_ms: float):
+        self.latency = latency_ms / 1000.0
+        self.linked: set[str] = set()
+
+    def _user(self, chat_id: str) -> dict:
+        return {"id": int(chat_id), "display_name": f"User {chat_id}", "email": f"{chat_id}@example.com",
+                "level": 1, "xp": 0, "coins": 0, "company": None}
+
+    async def summary(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.latency)
+        chat_id = request.query.get("chat_id") or ""
+        if chat_id not in self.linked:
+            return web.json_response({"ok": True, "linked": False, "items": []})
+        version = f"v-{chat_id}"
+        if version in (request.headers.get("If-None-Match") or ""):
+            return web.Response(status=304, headers={"ETag": f'"{version}"'})
+        return web.json_response({"ok": True, "linked": True, "version": version, "user": self._user(chat_id),
+                                  "unread_count": 0, "items": []}, headers={"ETag": f'"{version}"'})
+
+    async def link(self, request: web.Request) -> web.Response:
+        # заглушка принимает любой код
+        await asyncio.sleep(self.latency)
+        data = await request.json()
+        chat_id = str(data.get("chat_id") or "")
+        self.linked.add(chat_id)
+        return web.json_response({"ok": True, "user_id": int(chat_id), "user": self._user(chat_id)})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/api/telegram/bot/summary", self.summary)
+        app.router.add_post("/api/telegram/bot/link", self.link)
+        return app
+
+
+async def _serve(app: web.Application) -> tuple[web.AppRunner, str]:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
+
+
+# ======== Коды привязки ========
+class LinkFailed(Exception):
+    pass
+
+def _load_codes(path: str) -> list[str]:
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+def _seed_codes(n: int) -> list[str]:
+    """Выпускает коды через само приложение — так же, как кнопка «Сгенерировать код» в профиле."""
+    os.environ["TG_OUTBOX_IN_PROCESS"] = "0"  # доставкой здесь заниматься не нужно
+    import app as backend
+    with backend.app.app_context():
+        users = (backend.User.query.filter(backend.User.telegram_chat_id.is_(None))
+                 .order_by(backend.User.id).limit(n).all())
+        return [backend._get_or_make_unique_code(u) for u in users]
+
+
+# ======== Сценарий ========
+async def _chat(tg: FakeTelegram, chat_id: int, code: str, args, latencies: list[float], errors: list[int]):
+    await asyncio.sleep(random.uniform(0, args.ramp))
+    steps = ["/start", code, "👤 Профиль"] + ["🔔 Уведомления"] * args.presses
+    for i, text in enumerate(steps):
+        t0 = time.perf_counter()
+        fut = tg.inject(chat_id, text)
+        try:
+            t1, reply = await asyncio.wait_for(fut, timeout=args.reply_timeout)
+            latencies.append((t1 - t0) * 1000.0)
+        except asyncio.TimeoutError:
+            errors.append(chat_id)
+            reply = ""
+        if i == 1 and "Готово" not in reply:
+            raise LinkFailed(f"chat {chat_id}: code {code!r} not accepted: {reply[:120]!r}")
+        if args.think:
+            await asyncio.sleep(random.uniform(0, args.think * 2))
+
+
+def _pct(xs: list[float], q: float) -> float:
+    if not xs:
+        return 0.0
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * q))]
+
+
+async def run(args) -> None:
+    if args.backend:
+        codes = _load_codes(args.codes) if args.codes else _seed_codes(args.chats)
+        if len(codes) < args.chats:
+            sys.exit(f"need {args.chats} link codes for a real backend, got {len(codes)}")
+    else:
+        codes = [f"CODE{i:05d}" for i in range(args.chats)]
+
+    tg = FakeTelegram()
+    tg_runner, tg_base = await _serve(tg.app())
+    be_runner = None
+    backend_url = args.backend
+    if not backend_url:
+        be_runner, backend_url = await _serve(FakeBackend(args.backend_latency_ms).app())
+
+    # bot.py читает настройки при импорте
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": FAKE_TOKEN,
+        "TELEGRAM_API_BASE": tg_base,
+        "BACKEND_URL": backend_url,
+        "BOT_MODE": "polling",
+        "BOT_CONTROL_PORT": "0",
+        "BOT_METRICS_LOG_SEC": "0",
+        "BOT_HANDLER_CONCURRENCY": str(args.concurrency),
+    })
+    import bot
+
+    bot_task = asyncio.create_task(bot.main())
+    await asyncio.sleep(0.5)
+
+    latencies: list[float] = []
+    errors: list[int] = []
+    base_id = 10_000_000
+    t0 = time.perf_counter()
+    tasks = [asyncio.create_task(_chat(tg, base_id + i, codes[i], args, latencies, errors))
+             for i in range(args.chats)]
+    failure = None
+    try:
+        await asyncio.gather(*tasks)
+    except LinkFailed as e:
+        failure = e
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.perf_counter() - t0
+
+    bot_task.cancel()
+    try:
+        await bot_task
+    except (asyncio.CancelledError, Exception):
+        pass
+    await tg_runner.cleanup()
+    if be_runner:
+        await be_runner.cleanup()
+
+    if failure:
+        sys.exit(f"link failed, aborting: {failure}")
+
+    updates = len(latencies) + len(errors)
+    metrics = bot.backend.metrics()
+    calls = sum(m["calls"] for m in metrics.values())
+    print(f"chats={args.chats} updates={updates} answered={len(latencies)} timeouts={len(errors)} "
+          f"elapsed={elapsed:.1f}s")
+    print(f"latency ms: p50={_pct(latencies, 0.5):.1f} p90={_pct(latencies, 0.9):.1f} "
+          f"p99={_pct(latencies, 0.99):.1f} max={max(latencies or [0]):.1f}")
+    print(f"throughput: {tg.sent / elapsed:.1f} msg/s sent, {updates / elapsed:.1f} updates/s")
+    print(f"backend calls: {calls} total, {calls / max(1, updates):.2f} per update")
+    for path, m in sorted(metrics.items()):
+        print(f"  {path}: calls={m['calls']} err={m['errors']} p50={m['p50_ms']}ms p95={m['p95_ms']}ms")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Нагрузочный прогон Telegram-бота на заглушках")
+    ap.add_argument("--chats", type=int, default=1000)
+    ap.add_argument("--presses", type=int, default=3, help="нажатий «🔔 Уведомления» на чат")
+    ap.add_argument("--ramp", type=float, default=5.0, help="разброс старта чатов, с")
+    ap.add_argument("--think", type=float, default=0.2, help="средняя пауза между шагами, с")
+    ap.add_argument("--reply-timeout", type=float, default=30.0)
+    ap.add_argument("--concurrency", type=int, default=64, help="BOT_HANDLER_CONCURRENCY")
+    ap.add_argument("--backend", default="", help="URL настоящего Flask вместо заглушки")
+    ap.add_argument("--codes", default="", help="файл с кодами привязки (по одному на строку) для --backend")
+    ap.add_argument("--seed-codes", action="store_true",
+                    help="выпустить коды через app.py для --backend (меняет БД: только тестовая база)")
+    ap.add_argument("--backend-latency-ms", type=float, default=5.0, help="задержка ответа заглушки бэкенда")
+    args = ap.parse_args()
+    if args.backend and not (args.codes or args.seed_codes):
+        ap.error("--backend needs real link codes: pass --codes FILE or --seed-codes")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,8 @@
 # extensions.py
 from flask_sqlalchemy import SQLAlchemy
+from apscheduler.schedulers.background import BackgroundScheduler
 
 db = SQLAlchemy()
+
+# Общий планировщик фоновых задач (дедлайны, синки). Все даты в БД — наивный UTC.
+scheduler = BackgroundScheduler(timezone="UTC", daemon=True)
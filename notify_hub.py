@@ -0,0 +1,96 @@
+# notify_hub.py
+"""
+In-process pub/sub для потока уведомлений (/api/notifications/stream).
+
+Хаб хранит только «последний id уведомления» на адресата ("u", user_id) / ("p", partner_id)
+и будит ждущие SSE-соединения после коммита. Сами уведомления читаются из БД по id > since,
+поэтому пропущенный publish ничем не грозит: поток периодически перечитывает БД
+(NOTIFY_STREAM_RESYNC_SEC) — это покрывает уведомления, созданные в другом процессе.
+
+NOTIFY_STREAM=0 отключает хаб: эндпоинт отвечает 503, а клиент возвращается к опросу.
+Каждое SSE-соединение держит поток веб-сервера, поэтому лимит зависит от воркера (capacity):
+  - gevent/eventlet (и dev-сервер werkzeug) — NOTIFY_STREAM_MAX_CONN;
+  - потоковый воркер (gunicorn --threads N, N задаётся в NOTIFY_STREAM_WORKER_THREADS) —
+    не больше половины потоков, остальные обслуживают обычные запросы;
+  - sync-воркер — 0: страница поток не открывает вовсе и сразу работает опросом.
+Сверх лимита — 503 и опрос.
+"""
+from __future__ import annotations
+
+import os
+import sys
+import threading
+import time
+from typing import Dict, Iterable, Tuple
+
+ENABLED = os.getenv("NOTIFY_STREAM", "1") not in ("0", "false", "False")
+MAX_CONN = int(os.getenv("NOTIFY_STREAM_MAX_CONN", "200"))
+WORKER_THREADS = int(os.getenv("NOTIFY_STREAM_WORKER_THREADS", "0"))  # потоков на воркер (gunicorn --threads)
+
+Key = Tuple[str, int]
+
+
+def _cooperative() -> bool:
+    """Воркер на green-потоках: висящее соединение не занимает поток ОС."""
+    gm = sys.modules.get("gevent.monkey")
+    if gm is not None and gm.is_module_patched("socket"):
+        return True
+    ep = sys.modules.get("eventlet.patcher")
+    return ep is not None and ep.is_monkey_patched("socket")
+
+
+def capacity(environ) -> int:
+    """Сколько SSE-соединений может держать этот воркер (0 — только опрос)."""
+    if not ENABLED:
+        return 0
+    if _cooperative() or str(environ.get("SERVER_SOFTWARE", "")).startswith("Werkzeug"):
+        return MAX_CONN
+    if environ.get("wsgi.multithread") and WORKER_THREADS > 1:
+        return min(MAX_CONN, WORKER_THREADS // 2)
+    return 0
+
+
+class NotifyHub:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._latest: Dict[Key, int] = {}
+        self.listeners = 0
+
+    def enter(self, limit: int = MAX_CONN) -> bool:
+        with self._cond:
+            if not ENABLED or self.listeners >= limit:
+                return False
+            self.listeners += 1
+            return True
+
+    def leave(self) -> None:
+        with self._cond:
+            self.listeners = max(0, self.listeners - 1)
+
+    def publish(self, items: Iterable[Tuple[Key, int]]) -> None:
+        with self._cond:
+            changed = False
+            for key, nid in items:
+                if nid > self._latest.get(key, 0):
+                    self._latest[key] = nid
+                    changed = True
+            if changed:
+                self._cond.notify_all()
+
+    def latest(self, key: Key) -> int:
+        with self._cond:
+            return self._latest.get(key, 0)
+
+    def wait(self, key: Key, since: int, timeout: float) -> bool:
+        """Блокирует до появления уведомления с id > since (True) или до таймаута (False)."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._latest.get(key, 0) <= since:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                self._cond.wait(left)
+            return True
+
+
+hub = NotifyHub()
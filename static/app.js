@@ -1376,6 +1376,11 @@ document.addEventListener('alpine:init', () => {
 
   async function notifyUnread() {
     try {
+      // сначала дешёвый счётчик: полный список тянем только если есть непрочитанные
+      const c = await fetch('/api/notifications/unread_count');
+      if (!c.ok) return;
+      const cj = await c.json();
+      if (!cj.unread) return;
       const r = await fetch('/api/notifications?unread_only=1');
       const j = await r.json();
       const items = Array.isArray(j.notifications) ? j.notifications : [];
@@ -1383,7 +1388,11 @@ document.addEventListener('alpine:init', () => {
       items.forEach(n => {
         pushToast({ title: n.title || 'Уведомление', text: n.body || '' });
       });
-      await fetch('/api/notifications/read', { method: 'POST' });
+      await fetch('/api/notifications/read', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ ids: items.map(n => n.id) })
+      });
     } catch (e) {
       console.warn('notifyUnread failed', e);
     }
@@ -1395,6 +1404,12 @@ document.addEventListener('alpine:init', () => {
     notifyUnread();
   }
 
+  // новые уведомления приходят из SSE-потока (base.html) — показываем тостом без опроса
+  window.addEventListener('sj:notification', (e) => {
+    const n = e.detail || {};
+    pushToast({ title: n.title || 'Уведомление', text: n.body || '' });
+  });
+
   window.SJ = window.SJ || {};
   window.SJ.notifyUnread = notifyUnread;
 })();
@@ -0,0 +1,468 @@
+# telegram_outbox.py
+"""
+Исходящая доставка в Telegram без блокировки веб-воркеров.
+
+Сообщения пишутся в персистентную таблицу telegram_outbox (в той же транзакции,
+что и породившие их данные), а пул потоков-воркеров отправляет их через один
+пуловый httpx.Client, соблюдая лимиты Bot API:
+  - глобальный token bucket (по умолчанию 25 msg/s при лимите ~30),
+  - не чаще 1 сообщения в секунду в личный чат и 20 в минуту в группу,
+  - 429 → ждём retry_after, 5xx/сеть → повтор с экспоненциальной паузой и джиттером,
+  - 400/403 (чат не найден, бот заблокирован) → failed без повторов.
+
+TELEGRAM_API_BASE позволяет направить доставку на локальную заглушку Bot API.
+
+Дайджест: уведомления (строки с kind) ждут TG_DIGEST_WINDOW_SEC, и всё, что накопилось
+в чат за окно, уходит одним сообщением («Проверка заданий — 3 · Дедлайны — 1» + заголовки).
+Поглощённые строки получают статус digested, голова — kind='digest' и больше ни с чем
+не склеивается (на повторах уходит как есть). TG_DIGEST_WINDOW_SEC=0 — без склейки.
+
+TELEGRAM_DELIVERY=bot — вместо прямых вызовов Bot API диспетчер передаёт созревшие пачки
+боту (bot_control.push → /control/push), и бот рассылает их сам через свою сессию.
+Очередь, ретраи и лимиты на чат остаются здесь, в outbox.
+"""
+from __future__ import annotations
+
+import html
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+
+import httpx
+from sqlalchemy import Index, func, select, update
+
+import bot_control
+from extensions import db
+
+
+# ======== ENV ========
+TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+
+TG_OUTBOX_WORKERS = int(os.getenv("TG_OUTBOX_WORKERS", "4"))
+TG_OUTBOX_BATCH = int(os.getenv("TG_OUTBOX_BATCH", "100"))
+TG_OUTBOX_POLL_SEC = float(os.getenv("TG_OUTBOX_POLL_SEC", "5"))
+TG_GLOBAL_RPS = float(os.getenv("TG_GLOBAL_RPS", "25"))
+TG_CHAT_INTERVAL_SEC = float(os.getenv("TG_CHAT_INTERVAL_SEC", "1.0"))
+TG_GROUP_PER_MIN = float(os.getenv("TG_GROUP_PER_MIN", "20"))
+TG_MAX_ATTEMPTS = int(os.getenv("TG_MAX_ATTEMPTS", "8"))
+TG_BACKOFF_MAX_SEC = float(os.getenv("TG_BACKOFF_MAX_SEC", "300"))
+TG_SENDING_STALE_SEC = int(os.getenv("TG_SENDING_STALE_SEC", "120"))
+TG_DIGEST_WINDOW_SEC = float(os.getenv("TG_DIGEST_WINDOW_SEC", "20"))
+TG_DIGEST_MAX_LINES = int(os.getenv("TG_DIGEST_MAX_LINES", "10"))
+TG_MESSAGE_MAX_CHARS = 4000  # лимит Bot API — 4096
+TELEGRAM_DELIVERY = os.getenv("TELEGRAM_DELIVERY", "direct").lower()  # direct|bot
+TG_PUSH_BATCH = int(os.getenv("TG_PUSH_BATCH", "50"))
+# 0 (по умолчанию) — доставкой занимается один выделенный процесс (BACKGROUND_JOBS=1): лимиты
+# _RateLimiter живут в памяти процесса, и N отправляющих процессов слали бы в N раз быстрее
+# TG_GLOBAL_RPS и ловили 429. 1 — воркеры в самом веб-процессе, только для однопроцессного запуска.
+TG_OUTBOX_IN_PROCESS = os.getenv("TG_OUTBOX_IN_PROCESS", "0") not in ("0", "false", "False")
+
+
+def _utcnow() -> datetime:
+    return datetime.utcnow()
+
+
+# ======== Model ========
+class TelegramOutbox(db.Model):
+    __tablename__ = "telegram_outbox"
+    id              = db.Column(db.Integer, primary_key=True)
+    chat_id         = db.Column(db.String(32), nullable=False, index=True)
+    text            = db.Column(db.Text, nullable=False)
+    parse_mode      = db.Column(db.String(16), nullable=True, default="HTML")
+    status          = db.Column(db.String(16), nullable=False, default="pending")  # pending|sending|sent|failed|digested
+    attempts        = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=_utcnow)
+    claim_token     = db.Column(db.String(32), nullable=True)
+    claimed_at      = db.Column(db.DateTime, nullable=True)
+    notification_id = db.Column(db.Integer, nullable=True)
+    kind            = db.Column(db.String(32), nullable=True)  # тип уведомления; NULL — служебное, 'digest' — готовый дайджест
+    last_error      = db.Column(db.String(255), nullable=True)
+    created_at      = db.Column(db.DateTime, nullable=False, default=_utcnow)
+    sent_at         = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (Index("ix_tg_outbox_due", "status", "next_attempt_at"),)
+
+
+# ======== Enqueue ========
+def format_notification(title: str, body: str | None) -> str:
+    text = f"<b>{html.escape(title or 'Уведомление')}</b>"
+    if body:
+        text += "\n" + html.escape(body)
+    return text
+
+DIGEST_KIND = "digest"
+
+_DIGEST_LABELS = {
+    "task_assigned": "Новые задания",
+    "task_due": "Дедлайны",
+    "task_submitted": "Отчёты на проверку",
+    "task_result": "Проверка заданий",
+    "system": "Системные",
+}
+
+def format_digest(items: list[tuple[str, str]]) -> str:
+    """[(kind, text)] → одно сообщение: счётчики по типам и заголовки уведомлений."""
+    counts: dict[str, int] = {}
+    for kind, _ in items:
+        counts[kind] = counts.get(kind, 0) + 1
+    summary = " · ".join(f"{html.escape(_DIGEST_LABELS.get(k, k))} — {n}" for k, n in counts.items())
+    lines = [f"<b>Новые уведомления: {len(items)}</b>", summary, ""]
+    size = sum(len(x) + 1 for x in lines)
+    shown = 0
+    for _, text in items[:TG_DIGEST_MAX_LINES]:
+        line = "• " + text.split("\n", 1)[0]  # первая строка — заголовок (<b>…</b>), теги закрыты
+        if size + len(line) + 1 > TG_MESSAGE_MAX_CHARS - 32:
+            break
+        lines.append(line)
+        size += len(line) + 1
+        shown += 1
+    if len(items) > shown:
+        lines.append(f"… и ещё {len(items) - shown}")
+    return "\n".join(lines)
+
+def outbox_row(chat_id: str, text: str, *, parse_mode: str | None = "HTML",
+               notification_id: int | None = None, kind: str | None = None) -> dict:
+    now = _utcnow()
+    due = now + timedelta(seconds=TG_DIGEST_WINDOW_SEC) if kind and TG_DIGEST_WINDOW_SEC > 0 else now
+    return {
+        "chat_id": str(chat_id), "text": text, "parse_mode": parse_mode,
+        "status": "pending", "attempts": 0, "next_attempt_at": due,
+        "notification_id": notification_id, "kind": kind, "created_at": now,
+    }
+
+# ======== Rate limits ========
+class _RateLimiter:
+    """Глобальный token bucket + минимальный интервал между сообщениями в один чат."""
+
+    def __init__(self, global_rps: float, chat_interval: float, group_per_min: float):
+        self._lock = threading.Lock()
+        self._rate = max(0.1, global_rps)
+        self._tokens = self._rate
+        self._ts = time.monotonic()
+        self._chat_interval = chat_interval
+        self._group_interval = 60.0 / max(0.1, group_per_min)
+        self._chat_next: dict[str, float] = {}
+
+    def take_global(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._rate, self._tokens + (now - self._ts) * self._rate)
+                self._ts = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+    def chat_delay(self, chat_id: str) -> float:
+        """0 — слот в чат занят за нами, иначе сколько секунд подождать."""
+        with self._lock:
+            now = time.monotonic()
+            nxt = self._chat_next.get(chat_id, 0.0)
+            if nxt > now:
+                return nxt - now
+            interval = self._group_interval if chat_id.startswith("-") else self._chat_interval
+            self._chat_next[chat_id] = now + interval
+            if len(self._chat_next) > 50_000:
+                self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+            return 0.0
+
+    def penalize(self, chat_id: str, seconds: float) -> None:
+        with self._lock:
+            until = time.monotonic() + seconds
+            self._chat_next[chat_id] = max(self._chat_next.get(chat_id, 0.0), until)
+
+
+# ======== Worker pool ========
+class OutboxWorker:
+    """
+    Диспетчер забирает созревшие строки outbox пачкой (claim через UPDATE … WHERE status='pending',
+    поэтому несколько процессов не отправят одно и то же), воркеры доставляют их по одной.
+    """
+
+    def __init__(self):
+        self._app = None
+        self._client: Optional[httpx.Client] = None
+        self._limiter = _RateLimiter(TG_GLOBAL_RPS, TG_CHAT_INTERVAL_SEC, TG_GROUP_PER_MIN)
+        self._queue: "queue.Queue[tuple]" = queue.Queue(maxsize=TG_OUTBOX_BATCH * 2)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads: list[threading.Thread] = []
+
+    def init_app(self, app) -> None:
+        self._app = app
+
+    @property
+    def running(self) -> bool:
+        return bool(self._threads)
+
+    @property
+    def via_bot(self) -> bool:
+        return TELEGRAM_DELIVERY == "bot" and bot_control.ENABLED
+
+    def start(self) -> bool:
+        if self.running or not self._app or not TELEGRAM_BOT_TOKEN:
+            return False
+        self._stop.clear()
+        if self.via_bot:
+            # доставку делает бот: нужен только диспетчер, пачки уходят синхронно
+            self._threads = [threading.Thread(target=self._dispatch_loop, name="tg-outbox-dispatch", daemon=True)]
+            self._threads[0].start()
+            self._app.logger.info("Telegram outbox: delivery via bot %s", ", ".join(bot_control.BOT_CONTROL_URLS))
+            return True
+        self._client = httpx.Client(
+            base_url=f"{TELEGRAM_API_BASE}/bot{TELEGRAM_BOT_TOKEN}",
+            timeout=httpx.Timeout(10.0, connect=5.0),
+            limits=httpx.Limits(max_connections=TG_OUTBOX_WORKERS,
+                                max_keepalive_connections=TG_OUTBOX_WORKERS),
+        )
+        self._threads = [threading.Thread(target=self._dispatch_loop, name="tg-outbox-dispatch", daemon=True)]
+        self._threads += [threading.Thread(target=self._worker_loop, name=f"tg-outbox-{i}", daemon=True)
+                          for i in range(max(1, TG_OUTBOX_WORKERS))]
+        for t in self._threads:
+            t.start()
+        self._app.logger.info("Telegram outbox: %s workers -> %s", TG_OUTBOX_WORKERS, TELEGRAM_API_BASE)
+        return True
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        self._wake.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+        if self._client:
+            self._client.close()
+            self._client = None
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    @property
+    def delivering(self) -> bool:
+        """Будет ли поставленное в outbox сообщение кем-то отправлено."""
+        return bool(TELEGRAM_BOT_TOKEN) and (self.running or not TG_OUTBOX_IN_PROCESS)
+
+    # ---- dispatcher ----
+    def _dispatch_loop(self) -> None:
+        self._recover_stale()
+        batch = TG_PUSH_BATCH if self.via_bot else TG_OUTBOX_BATCH
+        while not self._stop.is_set():
+            try:
+                claimed = self._claim(batch)
+            except Exception:
+                self._app.logger.exception("Telegram outbox: claim failed")
+                claimed = []
+            if self.via_bot:
+                if claimed:
+                    try:
+                        self._push_to_bot(claimed)
+                    except Exception:
+                        self._app.logger.exception("Telegram outbox: push to bot crashed")
+                        for item in claimed:
+                            self._finish(item[0], status="pending", delay=TG_BACKOFF_MAX_SEC, error="push crash")
+            else:
+                for item in claimed:
+                    self._queue.put(item)  # ограниченная очередь = backpressure
+            if len(claimed) >= batch:
+                continue
+            self._wake.wait(timeout=self._next_due_in())
+            self._wake.clear()
+
+    def _claim(self, limit: int) -> list[tuple]:
+        token = uuid.uuid4().hex
+        now = _utcnow()
+        with self._app.app_context():
+            due_ids = (select(TelegramOutbox.id)
+                       .where(TelegramOutbox.status == "pending", TelegramOutbox.next_attempt_at <= now)
+                       .order_by(TelegramOutbox.id)
+                       .limit(limit))
+            claim = TelegramOutbox.id.in_(due_ids)
+            if TG_DIGEST_WINDOW_SEC > 0:
+                # окно чата открыло самое раннее уведомление — забираем к нему все ждущие в этот чат
+                digestible = TelegramOutbox.kind.isnot(None) & (TelegramOutbox.kind != DIGEST_KIND)
+                due_chats = (select(TelegramOutbox.chat_id)
+                             .where(TelegramOutbox.id.in_(due_ids), digestible))
+                claim = claim | (digestible & TelegramOutbox.chat_id.in_(due_chats))
+            db.session.execute(
+                update(TelegramOutbox)
+                .where(claim, TelegramOutbox.status == "pending")
+                .values(status="sending", claim_token=token, claimed_at=now)
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+            rows = db.session.execute(
+                select(TelegramOutbox.id, TelegramOutbox.chat_id, TelegramOutbox.text,
+                       TelegramOutbox.parse_mode, TelegramOutbox.attempts, TelegramOutbox.kind)
+                .where(TelegramOutbox.claim_token == token)
+                .order_by(TelegramOutbox.id)
+            ).all()
+            return self._digest([tuple(r) for r in rows])
+
+    def _digest(self, rows: list[tuple]) -> list[tuple]:
+        """
+        Склеивает уведомления одного чата в первую строку группы (её текст заменяется дайджестом),
+        остальные помечаются digested. Служебные сообщения (kind IS NULL) и уже собранные дайджесты
+        (kind='digest', например на повторной отправке) идут как есть — иначе от прежнего дайджеста
+        в новом осталась бы одна строка.
+        """
+        out, groups = [], {}
+        for row in rows:
+            if row[5] is None or row[5] == DIGEST_KIND:
+                out.append(row[:5])
+            else:
+                groups.setdefault(row[1], []).append(row)
+        merged: list[int] = []
+        for chat_id, group in groups.items():
+            head = group[0]
+            if len(group) == 1:
+                out.append(head[:5])
+                continue
+            text = format_digest([(r[5], r[2]) for r in group])
+            db.session.execute(update(TelegramOutbox).where(TelegramOutbox.id == head[0])
+                               .values(text=text, kind=DIGEST_KIND)
+                               .execution_options(synchronize_session=False))
+            merged += [r[0] for r in group[1:]]
+            out.append((head[0], chat_id, text, head[3], max(r[4] for r in group)))
+        if merged:
+            db.session.execute(
+                update(TelegramOutbox).where(TelegramOutbox.id.in_(merged))
+                .values(status="digested", claim_token=None)
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+        out.sort(key=lambda r: r[0])
+        return out
+
+    def _next_due_in(self) -> float:
+        with self._app.app_context():
+            nxt = db.session.execute(
+                select(func.min(TelegramOutbox.next_attempt_at)).where(TelegramOutbox.status == "pending")
+            ).scalar()
+        if nxt is None:
+            return TG_OUTBOX_POLL_SEC
+        return min(TG_OUTBOX_POLL_SEC, max(0.05, (nxt - _utcnow()).total_seconds()))
+
+    def _recover_stale(self) -> None:
+        """Строки, зависшие в sending (процесс упал посреди отправки), возвращаем в очередь."""
+        cutoff = _utcnow() - timedelta(seconds=TG_SENDING_STALE_SEC)
+        with self._app.app_context():
+            db.session.execute(
+                update(TelegramOutbox)
+                .where(TelegramOutbox.status == "sending", TelegramOutbox.claimed_at < cutoff)
+                .values(status="pending", claim_token=None)
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+
+    # ---- workers ----
+    def _worker_loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                item = self._queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            try:
+                self._deliver(*item)
+            except Exception:
+                self._app.logger.exception("Telegram outbox: delivery crashed (id=%s)", item[0])
+                self._finish(item[0], status="pending", delay=TG_BACKOFF_MAX_SEC, error="worker crash")
+            finally:
+                self._queue.task_done()
+
+    def _deliver(self, row_id: int, chat_id: str, text: str, parse_mode: str | None, attempts: int) -> None:
+        delay = self._limiter.chat_delay(chat_id)
+        if delay > 0:
+            # в этот чат слать рано — откладываем без списания попытки, воркер не блокируем
+            self._finish(row_id, status="pending", delay=delay)
+            return
+
+        self._limiter.take_global()
+        payload = {"chat_id": chat_id, "text": text, "disable_web_page_preview": True}
+        if parse_mode:
+            payload["parse_mode"] = parse_mode
+        try:
+            r = self._client.post("/sendMessage", json=payload)
+        except httpx.HTTPError as e:
+            self._retry(row_id, attempts, f"{type(e).__name__}: {e}")
+            return
+
+        if r.status_code == 200:
+            self._finish(row_id, status="sent")
+        elif r.status_code == 429:
+            try:
+                retry_after = float(((r.json() or {}).get("parameters") or {}).get("retry_after") or 1)
+            except Exception:
+                retry_after = 1.0
+            self._limiter.penalize(chat_id, retry_after)
+            self._finish(row_id, status="pending", delay=retry_after, error="429")
+        elif r.status_code >= 500:
+            self._retry(row_id, attempts, f"HTTP {r.status_code}")
+        else:
+            self._finish(row_id, status="failed", error=f"HTTP {r.status_code}: {r.text[:200]}", attempt=True)
+
+    def _push_to_bot(self, items: list[tuple]) -> None:
+        """Пачка → бот. Лимиты на чат и глобальный темп соблюдаем здесь, бот только отправляет."""
+        ready = []
+        for row_id, chat_id, text, parse_mode, attempts in items:
+            delay = self._limiter.chat_delay(chat_id)
+            if delay > 0:
+                self._finish(row_id, status="pending", delay=delay)
+                continue
+            self._limiter.take_global()
+            ready.append((row_id, chat_id, text, parse_mode, attempts))
+        if not ready:
+            return
+
+        results = bot_control.push([{"id": r[0], "chat_id": r[1], "text": r[2], "parse_mode": r[3]}
+                                    for r in ready])
+        by_id = {int(x.get("id") or 0): x for x in (results or []) if isinstance(x, dict)}
+        for row_id, chat_id, _text, _pm, attempts in ready:
+            res = by_id.get(row_id)
+            if res is None:
+                self._retry(row_id, attempts, "bot unreachable" if results is None else "no result from bot")
+            elif res.get("status") == "sent":
+                self._finish(row_id, status="sent")
+            elif res.get("status") == "failed":
+                self._finish(row_id, status="failed", error=str(res.get("error") or "failed"), attempt=True)
+            elif res.get("retry_after"):
+                retry_after = float(res["retry_after"])
+                self._limiter.penalize(chat_id, retry_after)
+                self._finish(row_id, status="pending", delay=retry_after, error="429")
+            else:
+                self._retry(row_id, attempts, str(res.get("error") or "retry"))
+
+    def _retry(self, row_id: int, attempts: int, error: str) -> None:
+        attempts += 1
+        if attempts >= TG_MAX_ATTEMPTS:
+            self._finish(row_id, status="failed", error=error, attempt=True)
+            return
+        backoff = min(TG_BACKOFF_MAX_SEC, 2 ** attempts) * random.uniform(0.5, 1.5)
+        self._finish(row_id, status="pending", delay=backoff, error=error, attempt=True)
+
+    def _finish(self, row_id: int, *, status: str, delay: float = 0.0,
+                error: str | None = None, attempt: bool = False) -> None:
+        values = {"status": status, "claim_token": None}
+        if status == "sent":
+            values["sent_at"] = _utcnow()
+        if status == "pending":
+            values["next_attempt_at"] = _utcnow() + timedelta(seconds=delay)
+        if error:
+            values["last_error"] = error[:255]
+        if attempt:
+            values["attempts"] = TelegramOutbox.attempts + 1
+        with self._app.app_context():
+            db.session.execute(update(TelegramOutbox).where(TelegramOutbox.id == row_id).values(**values)
+                               .execution_options(synchronize_session=False))
+            db.session.commit()
+        if status == "pending":
+            self._wake.set()
+
+
+outbox = OutboxWorker()